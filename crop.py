@@ -14,7 +14,9 @@ camera's field of view in each picture; except one picture, specified by
 
 Each image is processed to find the die in it. That region is cropped out, and
 the result is saved into the output subdirectory (crop/) with the same name as
-the corresponding input image.
+the corresponding input image. With --dice, several dice are found in each
+image, and their crops are named with suffixes (such as 00042_a.JPG and
+00042_b.JPG).
 
 The camera should be on full manual, including:
  - focus
@@ -25,9 +27,21 @@ On a 2.4GHz i5 MacBook Pro, this takes about 10 minutes for 3k images.
 
 import argparse
 import collections
+import contextlib
+import hashlib
 import json
+import math
 import multiprocessing
 import os
+import shutil
+import signal
+import string
+import subprocess
+import sys
+import time
+
+import cv2
+import numpy
 
 import PIL
 import PIL.Image
@@ -44,6 +58,35 @@ BOUNDS_AREA_MAX = 7.0
 BOUNDS_AREA_MIN = 2.0
 PIXEL_AREA_MIN = 1.5
 PIXEL_AREA_ABORT_MAX = 5.0
+DIFF_COLOR_ADJUST = (40, -20, -20)  # tints a region when debugging
+# How many filenames to send to a worker process at a time.
+CROP_CHUNK_SIZE = 4
+# Errors from a capture which cannot be read or cropped (such as a truncated
+# or unreadable image, the wrong image size, or jpegtran failing), which are
+# recorded for that capture without stopping the rest.
+CROP_ERRORS = (
+    OSError, ValueError, RuntimeError, subprocess.CalledProcessError)
+WATCH_POLL_SEC = 2.0
+CROP_MANIFEST = 'cropmanifest.jsonl'
+CROP_ROI = 'croproi.png'
+CROP_DIFF_CACHE = 'cropdiffs'
+CROP_CALIBRATION = 'cropcalibration.json'
+# How many crops must be in the manifest to learn a region of interest.
+ROI_LEARN_MIN_CROPS = 20
+# Calibration recommends a crop size with this margin around the die, and an
+# analysis resize factor which makes the die about this many pixels across.
+CALIBRATE_SAMPLE_DEFAULT = 30
+CALIBRATE_CROP_MARGIN = 1.3
+CALIBRATE_ANALYSIS_DIE_SIZE = 75
+# How crops can be written: re-encoded as JPEG (PIL default quality), cut out
+# of the capture losslessly by jpegtran, or as lossless PNG.
+CROP_FORMATS = ('jpeg', 'jpegtran', 'png')
+CROP_FORMAT_DEFAULT = 'jpeg'
+# Lossless JPEG crops must start on an iMCU boundary, which is at most 16px.
+JPEG_BLOCK_SIZE = 16
+# With several dice per capture, crops are suffixed _a, _b, ... from the top of
+# the capture down.
+DICE_MAX = len(string.ascii_lowercase)
 
 
 def _Summarize(name, image):
@@ -74,12 +117,16 @@ class DiffArea(object):
     self.y_min = min(self.y_min, y)
     self.y_max = max(self.y_max, y)
 
+  @property
+  def pixel_count(self):
+    return len(self.region)
+
   def CheckAbort(self):
     """Checks for unrecoverable errors and raises NoDieFoundError."""
-    if len(self.region) > PIXEL_AREA_ABORT_MAX * self.target_area:
+    if self.pixel_count > PIXEL_AREA_ABORT_MAX * self.target_area:
       raise NoDieFoundError(
           'Too much differing area (%d) to find die.'
-          % len(self.region))
+          % self.pixel_count)
 
   def Check(self):
     """Checks validity of the area. When this fails, try another region."""
@@ -87,20 +134,24 @@ class DiffArea(object):
         self.eccentricity < ECCENTRICITY_MAX and
         self.area < (BOUNDS_AREA_MAX * self.target_area) and
         self.area >= (BOUNDS_AREA_MIN * self.target_area) and
-        len(self.region) >= (PIXEL_AREA_MIN * self.target_area))
+        self.pixel_count >= (PIXEL_AREA_MIN * self.target_area))
 
   def DrawAreaOnDiff(self):
     """Draws the pixels and their bound on the image, for debugging."""
     if not self.region:
       return
 
+    dr, dg, db = DIFF_COLOR_ADJUST
     for (x, y) in self.region:
       r, g, b = self.diff.getpixel((x, y))
-      self.diff.putpixel((x, y), (r + 40, g - 20, b - 20))
-    for x in xrange(self.x_min, self.x_max + 1, 2):
+      self.diff.putpixel((x, y), (r + dr, g + dg, b + db))
+    self._DrawBound()
+
+  def _DrawBound(self):
+    for x in range(self.x_min, self.x_max + 1, 2):
       self.diff.putpixel((x, self.y_min), (0, 254, 0))
       self.diff.putpixel((x, self.y_max), (0, 254, 0))
-    for y in xrange(self.y_min + 1, self.y_max, 2):
+    for y in range(self.y_min + 1, self.y_max, 2):
       self.diff.putpixel((self.x_min, y), (0, 254, 0))
       self.diff.putpixel((self.x_max, y), (0, 254, 0))
 
@@ -123,29 +174,48 @@ class DiffArea(object):
     return (self.x_min, self.y_min, self.x_max, self.y_max)
 
   def __str__(self):
-    if not self.region:
+    if not self.pixel_count:
       return 'empty'
     return 'area %d px (%d%% target) %d bounds (%d%%) e=%.2f' % (
-        len(self.region),
-        int(100 * len(self.region) / self.target_area),
+        self.pixel_count,
+        int(100 * self.pixel_count / self.target_area),
         self.area,
         int(100 * self.area / self.target_area),
         self.eccentricity)
 
 
-def FindLargeDiffBound(diff, scan_distance, diff_threshold, debug=False):
+def GetScanLines(h, scan_distance, row_priority=None):
+  """Returns the y coordinates of scan lines, in the order to search them.
+
+  Lines are every scan_distance rows. If row_priority (a value per row) is
+  given, lines in higher priority rows are searched first.
+  """
+  scan_lines = numpy.arange(scan_distance // 2, h, scan_distance)
+  if row_priority is not None:
+    scan_lines = scan_lines[
+        numpy.argsort(-row_priority[scan_lines], kind='stable')]
+  return scan_lines
+
+
+def IterLargeDiffBounds(
+    diff, scan_distance, diff_threshold, debug=False, row_priority=None):
   """Scans the image in horizontal lines at scan_distance intervals. When
   we find a stripe that's all above threshold about scan_distance/2 long,
-  flood-fill it. If the total area is >= scan_distance**2, return its bounds.
+  flood-fill it. If the total area is >= scan_distance**2, yield its bounds,
+  then keep scanning for more.
 
+  The diff is a PIL image or (h, w, 3) array of per-channel differences.
   If debug is true, draw scan lines and bounds on the diff image.
+  See GetScanLines for row_priority.
   """
+  if isinstance(diff, numpy.ndarray):
+    diff = PIL.Image.fromarray(diff)
   w, h = diff.size
   recent_found_num = 0
   sliding_window = []
   visited = set()
-  for y in xrange(scan_distance / 2, h, scan_distance):
-    for x in xrange(w):
+  for y in GetScanLines(h, scan_distance, row_priority).tolist():
+    for x in range(w):
       xy = (x, y)
       r, g, b = diff.getpixel(xy)
       if sum((r, g, b)) > diff_threshold and xy not in visited:
@@ -161,8 +231,8 @@ def FindLargeDiffBound(diff, scan_distance, diff_threshold, debug=False):
         if sliding_window.pop(0) is not None:
           recent_found_num -= 1
 
-      if recent_found_num > scan_distance / 2:
-        active = set(filter(bool, sliding_window[-scan_distance / 2:]))
+      if recent_found_num > scan_distance // 2:
+        active = set(filter(bool, sliding_window[-(scan_distance // 2):]))
         if debug:
           for ax, ay in active:
             diff.putpixel((ax, ay), (254, 0, 0))
@@ -174,8 +244,8 @@ def FindLargeDiffBound(diff, scan_distance, diff_threshold, debug=False):
           if sum((r, g, b)) > diff_threshold:
             diff_area.Add(i, j)
             diff_area.CheckAbort()
-            for dx in xrange(-1, 2):
-              for dy in xrange(-1, 2):
+            for dx in range(-1, 2):
+              for dy in range(-1, 2):
                 nx, ny = (i + dx, j + dy)
                 if ((dx, dy) != (0, 0)
                     and nx >= 0 and nx < w and ny >= 0 and ny < h
@@ -188,11 +258,208 @@ def FindLargeDiffBound(diff, scan_distance, diff_threshold, debug=False):
               '' if region_valid else 'in', x, y, diff_area))
           diff_area.DrawAreaOnDiff()
         if region_valid:
-          return diff_area.bound
+          yield diff_area.bound
 
         recent_found_num = 0
         sliding_window = []
-  raise NoDieFoundError('No valid diff found.')
+
+
+def FindLargeDiffBound(
+    diff, scan_distance, diff_threshold, debug=False, row_priority=None):
+  """Returns the first bound from IterLargeDiffBounds."""
+  return TakeBounds(IterLargeDiffBounds(
+      diff, scan_distance, diff_threshold, debug, row_priority), 1)[0]
+
+
+class ComponentDiffArea(DiffArea):
+  """A DiffArea made of whole connected components, described by their stats.
+
+  Rather than collecting pixels one at a time, this takes the labels and
+  statistics from cv2.connectedComponentsWithStats for a set of components.
+  """
+  def __init__(self, diff, target_area, labels, stats, component_ids):
+    super(ComponentDiffArea, self).__init__(diff, target_area)
+    self._labels = labels
+    self._component_ids = component_ids
+    component_stats = stats[component_ids]
+    self._pixel_count = int(component_stats[:, cv2.CC_STAT_AREA].sum())
+    if not len(component_ids):
+      return
+    left = component_stats[:, cv2.CC_STAT_LEFT]
+    top = component_stats[:, cv2.CC_STAT_TOP]
+    self.x_min = int(left.min())
+    self.x_max = int((left + component_stats[:, cv2.CC_STAT_WIDTH]).max() - 1)
+    self.y_min = int(top.min())
+    self.y_max = int((top + component_stats[:, cv2.CC_STAT_HEIGHT]).max() - 1)
+
+  @property
+  def pixel_count(self):
+    return self._pixel_count
+
+  def DrawAreaOnDiff(self):
+    if not self._pixel_count:
+      return
+    pixels = numpy.asarray(self.diff, dtype=numpy.int16).copy()
+    pixels[numpy.isin(self._labels, self._component_ids)] += DIFF_COLOR_ADJUST
+    self.diff.paste(PIL.Image.fromarray(
+        numpy.clip(pixels, 0, 255).astype(numpy.uint8)))
+    self._DrawBound()
+
+
+def IterComponentDiffBounds(
+    diff, scan_distance, diff_threshold, debug=False, row_priority=None):
+  """Yields the same bounds as IterLargeDiffBounds, using bulk array operations.
+
+  The whole diff is thresholded and split into 8-connected components at once.
+  The scan lines of IterLargeDiffBounds are then replayed over component labels:
+  where the sliding window would have started a flood fill, the components
+  under the window's seed pixels are exactly what the fill would reach, so
+  their statistics are checked with the same DiffArea rules.
+
+  The diff is a PIL image or (h, w, 3) array of per-channel differences, or an
+  (h, w) array of differences already summed across channels (see SumDiff).
+  If debug is true, draw checked regions and their bounds on the diff image,
+  which must then be a PIL image. See GetScanLines for row_priority.
+  """
+  diff_sum = numpy.asarray(diff)
+  if diff_sum.ndim == 3:
+    diff_sum = diff_sum.sum(axis=2, dtype=numpy.int16)
+  above_threshold = (diff_sum > diff_threshold).astype(numpy.uint8)
+  num_labels, labels, stats, _ = cv2.connectedComponentsWithStats(
+      above_threshold, connectivity=8)
+
+  half_scan = scan_distance // 2
+  window_len = 2 * scan_distance
+  # The scan lines, end to end, as the sliding window sees them.
+  scan_lines = GetScanLines(labels.shape[0], scan_distance, row_priority)
+  scanned = labels[scan_lines].ravel()
+  # Filled components (and the background) no longer count as found pixels.
+  visited = numpy.zeros(num_labels, dtype=bool)
+  visited[0] = True
+  start = 0
+  while start < len(scanned):
+    found = ~visited[scanned[start:]]
+    found_count = numpy.cumsum(found)
+    window_count = found_count.copy()
+    window_count[window_len:] -= found_count[:-window_len]
+    triggers = numpy.flatnonzero(window_count > half_scan)
+    if not len(triggers):
+      break
+    end = triggers[0] + 1
+    seed_len = half_scan if half_scan else window_len
+    seed_start = max(0, end - seed_len)
+    seeds = scanned[start + seed_start:start + end][found[seed_start:end]]
+    component_ids = numpy.unique(seeds)
+    visited[component_ids] = True
+
+    diff_area = ComponentDiffArea(
+        diff, scan_distance**2, labels, stats, component_ids)
+    diff_area.CheckAbort()
+    region_valid = diff_area.Check()
+    if debug:
+      row, x = divmod(start + end - 1, labels.shape[1])
+      print('%svalid region at (%d, %d) %s' % (
+          '' if region_valid else 'in', x, scan_lines[row], diff_area))
+      diff_area.DrawAreaOnDiff()
+    if region_valid:
+      yield diff_area.bound
+    start += end
+
+
+def FindComponentDiffBound(
+    diff, scan_distance, diff_threshold, debug=False, row_priority=None):
+  """Returns the first bound from IterComponentDiffBounds."""
+  return TakeBounds(IterComponentDiffBounds(
+      diff, scan_distance, diff_threshold, debug, row_priority), 1)[0]
+
+
+def TakeBounds(bounds_iter, count):
+  """Returns up to count bounds which do not overlap, in the order found.
+
+  Bounds are from one of the LOCALIZATION_ENGINES; a bound overlapping one
+  already taken (such as another piece of the same die) is skipped. If the
+  engine gives up (for example, on a region with too much differing area)
+  after some dice were found, those are returned. Raises NoDieFoundError if
+  there are none.
+  """
+  taken = []
+  try:
+    for bound in bounds_iter:
+      if not any(BoundsOverlap(bound, t) for t in taken):
+        taken.append(bound)
+        if len(taken) == count:
+          break
+  except NoDieFoundError:
+    if not taken:
+      raise
+  if not taken:
+    raise NoDieFoundError('No valid diff found.')
+  return taken
+
+
+def BoundsOverlap(a, b):
+  """Checks whether two (x_min, y_min, x_max, y_max) bounds overlap."""
+  return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+
+# Each engine is a generator of bounds; see TakeBounds.
+LOCALIZATION_ENGINES = {
+  'scan': IterLargeDiffBounds,
+  'components': IterComponentDiffBounds,
+}
+LOCALIZATION_ENGINE_DEFAULT = 'components'
+PYRAMID_FACTOR_DEFAULT = 4
+
+
+class RegionOfInterest(object):
+  """Where to search for the die, as a density map at analysis resolution.
+
+  Pixels with zero density are never searched (nor even diffed). Elsewhere,
+  scan lines through higher density (where dice have more often landed) are
+  searched first. A plain black and white mask image works as a density map.
+  """
+  def __init__(self, density):
+    ys, xs = numpy.nonzero(density)
+    if not len(ys):
+      raise ValueError('Region of interest is empty.')
+    # Searching is limited to the bounding box of the region.
+    self.x_min, self.x_max = int(xs.min()), int(xs.max()) + 1
+    self.y_min, self.y_max = int(ys.min()), int(ys.max()) + 1
+    density = density[self.y_min:self.y_max, self.x_min:self.x_max]
+    self.outside = density == 0
+    self.row_priority = density.sum(axis=1, dtype=numpy.int64)
+
+  def Crop(self, pixels):
+    """Returns the part of an analysis-size array within the bounding box."""
+    return pixels[self.y_min:self.y_max, self.x_min:self.x_max]
+
+  @staticmethod
+  def Load(roi_path, analysis_size):
+    """Loads a density (or mask) image, scaling it to the analysis size."""
+    density = PIL.Image.open(roi_path).convert('L').resize(analysis_size)
+    return RegionOfInterest(numpy.asarray(density))
+
+
+def LearnRegionOfInterest(bounds_list, full_size, margin, roi_path):
+  """Writes a region of interest image from the bounds of previous crops.
+
+  The density is how many bounds, each grown by margin on all sides, cover
+  each pixel, scaled so the most covered pixel is white. It is written at full
+  size; RegionOfInterest.Load scales it down for analysis.
+  """
+  w, h = full_size
+  # Sum rectangles by marking their corners and then integrating.
+  corners = numpy.zeros((h + 1, w + 1), dtype=numpy.int32)
+  for x_min, y_min, x_max, y_max in bounds_list:
+    x_min, y_min = max(0, x_min - margin), max(0, y_min - margin)
+    x_max, y_max = min(w, x_max + margin), min(h, y_max + margin)
+    corners[y_min, x_min] += 1
+    corners[y_min, x_max] -= 1
+    corners[y_max, x_min] -= 1
+    corners[y_max, x_max] += 1
+  density = corners.cumsum(axis=0).cumsum(axis=1)[:h, :w]
+  scaled = numpy.ceil(density * 255.0 / max(1, density.max()))
+  PIL.Image.fromarray(scaled.astype(numpy.uint8)).save(roi_path)
 
 
 def MakeSquare(bounds, size, length):
@@ -219,6 +486,40 @@ def AdjustBound(x_min_in, x_max_in, x_exclusive_bound, length):
   return x_min, x_max
 
 
+def SnapToBlocks(bounds, block_size):
+  """Moves bounds up and left to start on a multiple of block_size."""
+  (x_min, y_min, x_max, y_max) = bounds
+  dx = x_min % block_size
+  dy = y_min % block_size
+  return (x_min - dx, y_min - dy, x_max - dx, y_max - dy)
+
+
+def GetCropFilename(raw_image_filename, crop_format, region=None):
+  """Returns the crop's filename, given the index of its region for captures
+  with several dice (see --dice).
+  """
+  base, extension = os.path.splitext(raw_image_filename)
+  if region is not None:
+    base += '_' + string.ascii_lowercase[region]
+  if crop_format == 'png':
+    extension = '.png'
+  return base + extension
+
+
+def CropLosslessly(in_path, bounds, out_path):
+  """Crops a JPEG with jpegtran, without decoding or recompressing it.
+
+  The bounds must start on a JPEG block boundary; see SnapToBlocks.
+  """
+  (x_min, y_min, x_max, y_max) = bounds
+  subprocess.check_call([
+      'jpegtran',
+      '-crop', '%dx%d+%d+%d' % (x_max - x_min, y_max - y_min, x_min, y_min),
+      '-copy', 'none',
+      '-outfile', out_path,
+      in_path])
+
+
 def CheckBoundSquareness(x_min, y_min, x_max, y_max):
   eccentricity = float(x_max - x_min) / (y_max - y_min)
   if eccentricity < 1.0:
@@ -228,100 +529,926 @@ def CheckBoundSquareness(x_min, y_min, x_max, y_max):
   return True
 
 
-class CropWorker(multiprocessing.Process):
+class PhaseTimer(object):
+  """Adds up the time spent in each named phase of processing."""
+  def __init__(self):
+    self.seconds = collections.Counter()
+
+  @contextlib.contextmanager
+  def Time(self, phase):
+    start = time.time()
+    try:
+      yield
+    finally:
+      self.seconds[phase] += time.time() - start
+
+
+def OpenForAnalysis(image_path, analysis_resize_factor, draft, timer=None):
+  """Opens an image and resizes it for analysis.
+
+  If draft is true, JPEG images are decoded directly at a reduced scale (1/2,
+  1/4 or 1/8, whichever is closest without going below the analysis size),
+  which is much faster than decoding at full resolution and then resizing.
+
+  Returns:
+    (full_size, resized_image, full_image), where full_size is the (w, h) of
+    the image as stored, regardless of any reduced-scale decoding, and
+    full_image is the image decoded at full resolution, or None if draft
+    decoding was used.
+  """
+  timer = timer or PhaseTimer()
+  with timer.Time('decode'):
+    image = PIL.Image.open(image_path)
+    w, h = image.size
+    analysis_size = (w // analysis_resize_factor, h // analysis_resize_factor)
+    if draft:
+      image.draft('RGB', analysis_size)
+    image.load()
+  with timer.Time('resize'):
+    resized_image = image.resize(analysis_size)
+  if image.size != (w, h):
+    image = None
+  return (w, h), resized_image, image
+
+
+def LoadReference(reference_path, analysis_resize_factor, draft):
+  """Returns the reference's full (w, h) and its analysis-size pixel array."""
+  size, resized_reference, unused_full_reference = OpenForAnalysis(
+      reference_path, analysis_resize_factor, draft)
+  return size, numpy.asarray(resized_reference)
+
+
+def SumDiff(pixels, reference_pixels):
+  """Returns the difference of two images summed across channels, as uint16."""
+  return numpy.abs(pixels.astype(numpy.int16) - reference_pixels).sum(
+      axis=2, dtype=numpy.uint16)
+
+
+class DiffCache(object):
+  """Analysis-size diffs of captures against the reference, kept on disk.
+
+  A single memory-mapped (captures, h, w) array holds each capture's SumDiff,
+  so thresholds can be tried again without decoding any captures. The index
+  records which captures are stored, and the reference and settings the diffs
+  were made with; if those change, the cache starts over. Pool processes get
+  copies of this object and write their rows into the shared file directly,
+  while the parent tracks what is stored and saves the index.
+  """
+  def __init__(self, cache_dir, key, filenames, shape):
+    if not os.path.isdir(cache_dir):
+      os.makedirs(cache_dir)
+    self._diffs_path = os.path.join(cache_dir, 'diffs.npy')
+    self._index_path = os.path.join(cache_dir, 'index.json')
+    self._key = key
+    self._diffs = None
+
+    index = {'filenames': [], 'stored': []}
+    if os.path.isfile(self._index_path) and os.path.isfile(self._diffs_path):
+      with open(self._index_path) as index_file:
+        old_index = json.load(index_file)
+      if old_index['key'] == key:
+        index = old_index
+    self.stored = set(index['stored'])
+    self._filenames = list(index['filenames'])
+    old_rows = dict((f, i) for i, f in enumerate(self._filenames))
+    new_filenames = [f for f in filenames if f not in old_rows]
+    if new_filenames or not self._filenames:
+      self._filenames.extend(new_filenames)
+      self._Reallocate(old_rows, shape)
+    self.rows = dict((f, i) for i, f in enumerate(self._filenames))
+    self.Save()
+
+  def _Reallocate(self, old_rows, shape):
+    """Makes room for all the filenames, keeping stored rows."""
+    temp_path = self._diffs_path + '.tmp.npy'
+    diffs = numpy.lib.format.open_memmap(
+        temp_path,
+        mode='w+',
+        dtype=numpy.uint16,
+        shape=(len(self._filenames),) + tuple(shape))
+    if old_rows and self.stored:
+      old_diffs = numpy.load(self._diffs_path, mmap_mode='r')
+      for i, filename in enumerate(self._filenames):
+        if filename in self.stored:
+          diffs[i] = old_diffs[old_rows[filename]]
+      del old_diffs
+    diffs.flush()
+    del diffs
+    os.rename(temp_path, self._diffs_path)
+
+  def __getstate__(self):
+    state = self.__dict__.copy()
+    state['_diffs'] = None  # Each process maps the file for itself.
+    return state
+
+  def _GetDiffs(self):
+    if self._diffs is None:
+      self._diffs = numpy.load(self._diffs_path, mmap_mode='r+')
+    return self._diffs
+
+  def Store(self, filename, diff_sum):
+    """Writes a capture's diff. The parent must then call MarkStored."""
+    if filename in self.rows:
+      self._GetDiffs()[self.rows[filename]] = diff_sum
+
+  def Load(self, filename):
+    return self._GetDiffs()[self.rows[filename]]
+
+  def MarkStored(self, filename):
+    if filename in self.rows:
+      self.stored.add(filename)
+
+  def Save(self):
+    with open(self._index_path, 'w') as index_file:
+      json.dump({
+        'key': self._key,
+        'filenames': self._filenames,
+        'stored': sorted(self.stored),
+      }, index_file)
+
+
+def ShareArray(array):
+  """Copies a uint8 array into shared memory for pool processes.
+
+  Returns (shared, shape), which can be passed to pool processes as
+  initializer arguments and then mapped with MapSharedArray.
+  """
+  shared = multiprocessing.RawArray('B', array.size)
+  numpy.frombuffer(shared, dtype=numpy.uint8)[:] = array.ravel()
+  return shared, array.shape
+
+
+def MapSharedArray(shared, shape):
+  """Returns a read-only array view of memory from ShareArray, without copying.
+  """
+  array = numpy.frombuffer(shared, dtype=numpy.uint8).reshape(shape)
+  array.flags.writeable = False
+  return array
+
+
+class CropWorker(object):
+  """Finds and crops out the die from captures, one process's worth of state.
+
+  The reference is given already resized for analysis, as (w, h) of the full
+  size image and an array of the analysis pixels, which is not modified.
+  """
   def __init__(self,
-      filename_queue,
-      result_queue,
+      full_size,
+      reference_pixels,
       capture_dir,
       crop_dir,
-      reference_filename,
       crop_size,
       analysis_resize_factor,
       diff_threshold,
+      engine,
+      pyramid_factor,
+      draft,
+      crop_format,
+      roi_path,
+      dice,
+      diff_cache,
       debug):
-    multiprocessing.Process.__init__(self)
-    self.daemon = True
-    self._filename_queue = filename_queue
-    self._result_queue = result_queue
-
     self._capture_dir = capture_dir
     self._crop_dir = crop_dir
     self._crop_size = crop_size
-    self._scan_distance = 2 * crop_size / 5
+    self._scan_distance = 2 * crop_size // 5
     self._analysis_resize_factor = analysis_resize_factor
     if diff_threshold is None or diff_threshold < 1:
       raise ValueError('Bad diff_threshold: %r' % diff_threshold)
     self._diff_threshold = diff_threshold
+    self._find_bounds = LOCALIZATION_ENGINES[engine]
+    self._pyramid_factor = pyramid_factor
+    self._draft = draft
+    self._crop_format = crop_format
+    self._dice = dice
+    self._diff_cache = diff_cache
     self._debug = debug
-    self._reference_filename = reference_filename
+    self.timer = PhaseTimer()
+    # How many analysis pixels were searched, and how often the pyramid search
+    # fell back to searching everything.
+    self.counts = collections.Counter()
+
+    self._w, self._h = full_size
+    self._reference_pixels = reference_pixels
+    self._roi = None
+    if roi_path:
+      h, w = reference_pixels.shape[:2]
+      self._roi = RegionOfInterest.Load(roi_path, (w, h))
+    self._search_reference = reference_pixels
+    if self._roi:
+      self._search_reference = self._roi.Crop(reference_pixels)
+    if pyramid_factor > 1:
+      h, w = self._search_reference.shape[:2]
+      coarse_size = (
+          max(1, w // pyramid_factor), max(1, h // pyramid_factor))
+      self._coarse_reference = cv2.resize(
+          self._search_reference, coarse_size, interpolation=cv2.INTER_AREA)
+      if self._roi:
+        # Blocks entirely outside the region of interest.
+        self._coarse_outside = cv2.resize(
+            self._roi.outside.astype(numpy.float32), coarse_size,
+            interpolation=cv2.INTER_AREA) > 1.0 - EPSILON
+
+  def Crop(self, raw_image_filename):
+    """Crops one capture, returning a CropResult.
 
-  def run(self):
+    A capture which cannot be read or cropped (for example, a truncated JPEG)
+    gives a failed result with the error, so other captures carry on.
+    """
+    source = None
     try:
-      self._Run()
-    except KeyboardInterrupt as e:
-      pass  # Exit but leat the controlling process clean up.
-    except multiprocessing.queues.Empty as e:
-      print('worker', self.pid, 'queue empty')
-
-  def _Run(self):
-    reference = PIL.Image.open(
-        os.path.join(self._capture_dir, self._reference_filename))
-    self._w, self._h = reference.size
-    self._rw = self._w / self._analysis_resize_factor
-    self._rh = self._h / self._analysis_resize_factor
-    resized_reference = reference.resize((self._rw, self._rh))
-
-    while not self._filename_queue.empty():
-      raw_image_filename = self._filename_queue.get(timeout=5.0)
-      cropped_file_path = os.path.join(crop_dir, raw_image_filename)
-      try:
-        bounds = self.ExtractSubject(raw_image_filename, resized_reference)
-        self._result_queue.put(CropResult(raw_image_filename, None, bounds))
-      except NoDieFoundError as e:
-        self._result_queue.put(
-            CropResult(raw_image_filename, e.message or 'not found', None))
+      with self.timer.Time('hash'):
+        source = GetSourceStats(
+            os.path.join(self._capture_dir, raw_image_filename))
+      region_bounds = self.ExtractSubject(raw_image_filename)
+      return CropResult(
+          raw_image_filename, None, region_bounds[0], source,
+          region_bounds=region_bounds if self._dice > 1 else None)
+    except NoDieFoundError as e:
+      return CropResult(
+          raw_image_filename, str(e) or 'not found', None, source)
+    except CROP_ERRORS as e:
+      return CropResult(
+          raw_image_filename, '%s: %s' % (type(e).__name__, e), None, source,
+          error=True)
 
-  def ExtractSubject(self, raw_image_filename, resized_reference):
-    """Finds the die in an image by comparing to a reference.
+  def CacheDiff(self, raw_image_filename):
+    """Stores a capture's diff in the diff cache, returning its filename."""
+    unused_size, image, unused_full_image = self._OpenForAnalysis(
+        raw_image_filename)
+    self._diff_cache.Store(
+        raw_image_filename,
+        SumDiff(numpy.asarray(image), self._reference_pixels))
+    return raw_image_filename
 
-    Scales the images down while performing the diff, then crops out the full
-    size image of the die from the original image and saves it.
+  def SweepThresholds(self, raw_image_filename, diff_thresholds):
+    """Searches a cached diff with each threshold, returning which found a die.
     """
-    orig_image = PIL.Image.open(
-        os.path.join(self._capture_dir, raw_image_filename))
-    if (self._w, self._h) != orig_image.size:
+    diff_sum = self._diff_cache.Load(raw_image_filename)
+    row_priority = None
+    if self._roi:
+      diff_sum = self._roi.Crop(diff_sum).copy()
+      diff_sum[self._roi.outside] = 0
+      row_priority = self._roi.row_priority
+    found = []
+    for diff_threshold in diff_thresholds:
+      try:
+        FindComponentDiffBound(
+            diff_sum,
+            self._scan_distance // self._analysis_resize_factor,
+            diff_threshold,
+            row_priority=row_priority)
+        found.append(True)
+      except NoDieFoundError:
+        found.append(False)
+    return found
+
+  def _OpenForAnalysis(self, raw_image_filename):
+    size, image, full_image = OpenForAnalysis(
+        os.path.join(self._capture_dir, raw_image_filename),
+        self._analysis_resize_factor,
+        self._draft,
+        self.timer)
+    if (self._w, self._h) != size:
       raise RuntimeError(
           '%s is %s but should be %s.' %
-          (raw_image_filename, orig_image.size, (self._w, self._h)))
-    image = orig_image.resize((self._rw, self._rh))
+          (raw_image_filename, size, (self._w, self._h)))
+    return size, image, full_image
+
+  def _Search(self, pixels, reference_pixels, outside, row_priority, count):
+    """Diffs analysis-size pixels and searches them with the engine.
 
+    Pixels marked outside are ignored. Returns up to count bounds, or raises
+    NoDieFoundError; see TakeBounds.
+    """
+    self.counts['searched_pixels'] += pixels.shape[0] * pixels.shape[1]
+    with self.timer.Time('diff'):
+      diff = numpy.abs(
+          pixels.astype(numpy.int16) - reference_pixels).astype(numpy.uint8)
+      if outside is not None:
+        diff[outside] = 0
     if self._debug:
-      _Summarize('analysis input', image)
-      _Summarize('analysis ref', resized_reference)
-    diff = PIL.ImageChops.difference(resized_reference, image)
+      diff = PIL.Image.fromarray(diff)  # for drawing on and showing
 
     try:
-      analysis_bound = FindLargeDiffBound(
-          diff,
-          self._scan_distance / self._analysis_resize_factor,
-          self._diff_threshold,
-          debug=self._debug)
+      with self.timer.Time('search'):
+        return TakeBounds(
+            self._find_bounds(
+                diff,
+                self._scan_distance // self._analysis_resize_factor,
+                self._diff_threshold,
+                debug=self._debug,
+                row_priority=row_priority),
+            count)
     finally:
       if self._debug:
         diff.show()  # TODO: Not all of these get shown in Preview / OS X.
 
-    bound = [self._analysis_resize_factor * b for b in analysis_bound]
-    regular_bound = MakeSquare(bound, orig_image.size, self._crop_size)
-    out_image = orig_image.crop(regular_bound)
+  def _SearchPyramid(self, pixels, outside, row_priority):
+    """Searches only around candidate regions found in a coarse diff.
+
+    The coarse diff is of block averages, pyramid_factor analysis pixels on a
+    side, and candidates are regions above threshold large enough to be part
+    of a die. Each candidate is searched at analysis size within a window
+    around it, two blocks larger on each side.
+
+    Returns None if the whole diff should be searched instead: fewer dice than
+    expected were found in the windows, or a die touched the edge of its
+    window, and so may extend past it.
+    """
+    scan_distance = self._scan_distance // self._analysis_resize_factor
+    margin = 2 * self._pyramid_factor
+    h, w = pixels.shape[:2]
+    coarse_h, coarse_w = self._coarse_reference.shape[:2]
+    with self.timer.Time('diff'):
+      coarse_diff = SumDiff(
+          cv2.resize(
+              pixels, (coarse_w, coarse_h), interpolation=cv2.INTER_AREA),
+          self._coarse_reference)
+      if outside is not None:
+        coarse_diff[self._coarse_outside] = 0
+    self.counts['searched_pixels'] += coarse_w * coarse_h
+    with self.timer.Time('search'):
+      num_labels, _, stats, _ = cv2.connectedComponentsWithStats(
+          (coarse_diff > self._diff_threshold).astype(numpy.uint8),
+          connectivity=8)
+    # Block averages blur the die's edges into the background, so be generous.
+    min_area = (
+        PIXEL_AREA_MIN * scan_distance**2 / (4 * self._pyramid_factor**2))
+    candidates = [
+        s for s in stats[1:] if s[cv2.CC_STAT_AREA] >= min_area]
+    # Search candidates in about the order the scan lines would reach them.
+    x_scale, y_scale = float(w) / coarse_w, float(h) / coarse_h
+    def CandidateOrder(s):
+      top = int(s[cv2.CC_STAT_TOP] * y_scale)
+      priority = 0 if row_priority is None else -row_priority[top]
+      return (priority, top, s[cv2.CC_STAT_LEFT])
+    candidates.sort(key=CandidateOrder)
+
+    found = []
+    for s in candidates:
+      x0 = max(0, int(s[cv2.CC_STAT_LEFT] * x_scale) - margin)
+      y0 = max(0, int(s[cv2.CC_STAT_TOP] * y_scale) - margin)
+      x1 = min(w, int(math.ceil(
+          (s[cv2.CC_STAT_LEFT] + s[cv2.CC_STAT_WIDTH]) * x_scale))
+          + margin)
+      y1 = min(h, int(math.ceil(
+          (s[cv2.CC_STAT_TOP] + s[cv2.CC_STAT_HEIGHT]) * y_scale))
+          + margin)
+      try:
+        window_bounds = self._Search(
+            pixels[y0:y1, x0:x1],
+            self._search_reference[y0:y1, x0:x1],
+            None if outside is None else outside[y0:y1, x0:x1],
+            None if row_priority is None else row_priority[y0:y1],
+            self._dice - len(found))
+      except NoDieFoundError:
+        continue
+      for x_min, y_min, x_max, y_max in window_bounds:
+        if ((x_min == 0 and x0 > 0) or (y_min == 0 and y0 > 0)
+            or (x_max == x1 - x0 - 1 and x1 < w)
+            or (y_max == y1 - y0 - 1 and y1 < h)):
+          return None
+        bound = (x_min + x0, y_min + y0, x_max + x0, y_max + y0)
+        # Windows may overlap, finding the same die twice.
+        if not any(BoundsOverlap(bound, f) for f in found):
+          found.append(bound)
+      if len(found) == self._dice:
+        break
+    if len(found) < self._dice:
+      return None
+    return found
+
+  def ExtractSubject(self, raw_image_filename):
+    """Finds the dice in an image by comparing to a reference.
+
+    Scales the images down while performing the diff, then crops out the full
+    size image of each die (up to the number of dice expected) from the
+    original image and saves it. With draft decoding, the original is only
+    decoded at full resolution once a die has been found. Returns the bounds
+    of each die.
+    """
+    raw_image_path = os.path.join(self._capture_dir, raw_image_filename)
+    size, image, full_image = self._OpenForAnalysis(raw_image_filename)
+
     if self._debug:
-      _Summarize('output', out_image)
-    out_image.save(os.path.join(self._crop_dir, raw_image_filename))
-    return bound
+      _Summarize('analysis input', image)
+    pixels = numpy.asarray(image)
+    if self._diff_cache:
+      with self.timer.Time('diff'):
+        self._diff_cache.Store(
+            raw_image_filename, SumDiff(pixels, self._reference_pixels))
+    outside = None
+    row_priority = None
+    x_offset, y_offset = 0, 0
+    if self._roi:
+      pixels = self._roi.Crop(pixels)
+      outside = self._roi.outside
+      row_priority = self._roi.row_priority
+      x_offset, y_offset = self._roi.x_min, self._roi.y_min
+
+    analysis_bounds = None
+    if self._pyramid_factor > 1:
+      analysis_bounds = self._SearchPyramid(pixels, outside, row_priority)
+      if analysis_bounds is None:
+        self.counts['pyramid_fallbacks'] += 1
+    if analysis_bounds is None:
+      analysis_bounds = self._Search(
+          pixels, self._search_reference, outside, row_priority, self._dice)
+    # Name dice by where they are, not which search found them first.
+    analysis_bounds.sort(key=lambda b: (b[1], b[0]))
 
+    bounds = [
+        [self._analysis_resize_factor * b
+         for b in (x_min + x_offset, y_min + y_offset,
+                   x_max + x_offset, y_max + y_offset)]
+        for x_min, y_min, x_max, y_max in analysis_bounds]
+    for region, bound in enumerate(bounds):
+      regular_bound = MakeSquare(bound, size, self._crop_size)
+      crop_path = os.path.join(self._crop_dir, GetCropFilename(
+          raw_image_filename,
+          self._crop_format,
+          region if self._dice > 1 else None))
+      if self._crop_format == 'jpegtran':
+        with self.timer.Time('crop'):
+          CropLosslessly(
+              raw_image_path, SnapToBlocks(regular_bound, JPEG_BLOCK_SIZE),
+              crop_path)
+        continue
 
+      with self.timer.Time('crop'):
+        if full_image is None:
+          # Draft decoding was used, so only now decode at full resolution.
+          full_image = PIL.Image.open(raw_image_path)
+          full_image.load()
+        out_image = full_image.crop(regular_bound)
+      if self._debug:
+        _Summarize('output', out_image)
+      with self.timer.Time('encode'):
+        if self._crop_format == 'png':
+          out_image.save(crop_path, compress_level=1)
+        else:
+          out_image.save(crop_path)
+    return bounds
+
+
+# The source is from GetSourceStats, and params are the crop.py arguments which
+# affect results (see GetCropParams). Both are missing from old manifests.
+# With --dice above 1, region_bounds lists the bounds of each die found, whose
+# crops are suffixed (see GetCropFilename); crop_bounds is the first of them.
+# error is True if the capture could not be read or cropped at all, in which
+# case not_found_message holds the error.
 CropResult = collections.namedtuple(
     'CropResult',
-    ('filename', 'not_found_message', 'crop_bounds'))
+    ('filename', 'not_found_message', 'crop_bounds', 'source', 'params',
+     'region_bounds', 'error'),
+    defaults=(None, None, None, None))
+
+
+def GetResultBounds(result):
+  """Returns [(crop filename region, bounds)] for each die in a CropResult."""
+  if result.region_bounds is not None:
+    return list(enumerate(result.region_bounds))
+  if result.crop_bounds is not None:
+    return [(None, result.crop_bounds)]
+  return []
+
+
+def GetSourceStats(path):
+  """Returns what identifies the contents of an input file, as a dict."""
+  stat = os.stat(path)
+  return {
+    'size': stat.st_size,
+    'mtime': stat.st_mtime,
+    'sha1': _HashFile(path),
+  }
+
+
+def _HashFile(path):
+  sha1 = hashlib.sha1()
+  with open(path, 'rb') as input_file:
+    for block in iter(lambda: input_file.read(1 << 20), b''):
+      sha1.update(block)
+  return sha1.hexdigest()
+
+
+def IsSourceUnchanged(source, path):
+  """Checks a file against GetSourceStats output, hashing only if needed."""
+  stat = os.stat(path)
+  if stat.st_size != source['size']:
+    return False
+  if stat.st_mtime == source['mtime']:
+    return True
+  return _HashFile(path) == source['sha1']
+
+
+def GetCropParams(args):
+  """Returns the arguments which affect crop results, as a dict."""
+  params = {
+    'diff_threshold': args.diff_threshold,
+    'crop_size': args.crop_size,
+    'analysis_resize_factor': args.analysis_resize_factor,
+    'draft': args.draft,
+    'crop_format': args.crop_format,
+    'roi': _HashFile(args.roi) if args.roi else None,
+  }
+  # Only recorded for several dice, so single die results stay current.
+  if args.dice > 1:
+    params['dice'] = args.dice
+  return params
+
+
+# The CropWorker for a pool process, set up by _InitCropWorker.
+_crop_worker = None
+
+
+def _InitCropWorker(
+    full_size, shared_reference, reference_shape, *crop_worker_args):
+  signal.signal(signal.SIGINT, signal.SIG_IGN)  # The parent handles ^C.
+  global _crop_worker
+  _crop_worker = CropWorker(
+      full_size,
+      MapSharedArray(shared_reference, reference_shape),
+      *crop_worker_args)
+
+
+def _RunChunk(method_name_items_args):
+  method_name, items, method_args = method_name_items_args
+  method = getattr(_crop_worker, method_name)
+  return [method(item, *method_args) for item in items]
+
+
+class CropPool(object):
+  """Runs CropWorkers in a pool of processes.
+
+  Filenames are sent to workers in chunks, and results are yielded as each
+  chunk finishes (not in input order). With one job, everything runs in this
+  process instead, which keeps --debug image display working.
+
+  The reference pixels are put in shared memory once, and every worker maps
+  that same copy. Use as a context manager; leaving it stops the workers.
+  """
+  def __init__(self, jobs, full_size, reference_pixels, crop_worker_args):
+    self._pool = None
+    self._crop_worker = None
+    if jobs == 1:
+      self._crop_worker = CropWorker(
+          full_size, reference_pixels, *crop_worker_args)
+    else:
+      shared_reference, reference_shape = ShareArray(reference_pixels)
+      self._pool = multiprocessing.Pool(
+          jobs,
+          _InitCropWorker,
+          (full_size, shared_reference, reference_shape)
+          + tuple(crop_worker_args))
+
+  def Run(self, method_name, raw_image_filenames, *method_args):
+    """Yields the result of a CropWorker method for each of the images."""
+    if self._crop_worker:
+      method = getattr(self._crop_worker, method_name)
+      for raw_image_filename in raw_image_filenames:
+        yield method(raw_image_filename, *method_args)
+      return
+    chunks = [
+        (method_name,
+         raw_image_filenames[i:i + CROP_CHUNK_SIZE],
+         method_args)
+        for i in range(0, len(raw_image_filenames), CROP_CHUNK_SIZE)]
+    for results in self._pool.imap_unordered(_RunChunk, chunks):
+      for result in results:
+        yield result
+
+  def CropAll(self, raw_image_filenames):
+    """Yields a CropResult for each of the images."""
+    return self.Run('Crop', raw_image_filenames)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *unused_exc_info):
+    if self._pool:
+      # Any work still queued is for an interrupted run, so drop it.
+      self._pool.terminate()
+      self._pool.join()
+
+
+class CropManifest(object):
+  """Record of crop results, kept in the data directory across runs.
+
+  Each CropResult records the source file's size, mtime and hash, and the
+  parameters it was cropped with, so re-runs can tell which results are still
+  current. The file has one JSON object per line, appended as each capture
+  finishes, so an interrupted run loses nothing. A later line for the same
+  capture replaces an earlier one.
+  """
+  def __init__(self, manifest_path):
+    self._manifest_path = manifest_path
+    self.results = collections.OrderedDict()
+    num_lines = 0
+    if os.path.isfile(manifest_path):
+      with open(manifest_path) as manifest_file:
+        for line in manifest_file:
+          if line.strip():
+            num_lines += 1
+            result = CropResult(**json.loads(line))
+            self.results[result.filename] = result
+    if num_lines > 2 * len(self.results):
+      self._Compact()
+
+  def _Compact(self):
+    """Rewrites the file without superseded lines."""
+    temp_path = self._manifest_path + '.tmp'
+    with open(temp_path, 'w') as manifest_file:
+      for result in self.results.values():
+        manifest_file.write(json.dumps(result._asdict()) + '\n')
+    os.rename(temp_path, self._manifest_path)
+
+  def Record(self, result):
+    self.results[result.filename] = result
+    with open(self._manifest_path, 'a') as manifest_file:
+      manifest_file.write(json.dumps(result._asdict()) + '\n')
+
+  def IsDone(self, filename, capture_dir, crop_dir, params, retry_failed):
+    """Checks whether a capture's recorded result is still current.
+
+    Results are current if the capture is unchanged and they were made with
+    the same params. With retry_failed, only failures are redone (whatever
+    params found the successful crops), and failures are always redone.
+    Captures cropped before the manifest recorded inputs are done if their
+    crop exists.
+    """
+    result = self.results.get(filename)
+    if result is None or result.source is None:
+      return os.path.isfile(os.path.join(
+          crop_dir, GetCropFilename(filename, params['crop_format'])))
+    crop_exists = all(
+        os.path.isfile(os.path.join(
+            crop_dir, GetCropFilename(filename, params['crop_format'], region)))
+        for region, _ in GetResultBounds(result))
+    if not IsSourceUnchanged(
+        result.source, os.path.join(capture_dir, filename)):
+      return False
+    if result.not_found_message is not None:
+      return not retry_failed and result.params == params
+    return crop_exists and (retry_failed or result.params == params)
+
+  def GetBounds(self, filenames):
+    """Returns the crop bounds recorded for every die found in the files."""
+    return [
+        bounds for filename in filenames if filename in self.results
+        for _, bounds in GetResultBounds(self.results[filename])]
+
+
+def IsCapture(filename, reference_filename):
+  return (filename.lower().endswith('jpg') and
+          filename.lower() != reference_filename.lower())
+
+
+def WatchCaptures(capture_dir, reference_filename, sentinel_filename, done):
+  """Yields lists of new captures as they are completely written.
+
+  A capture is ready once its size and mtime are unchanged between two polls,
+  so both files copied in place and files renamed into place are picked up.
+  Captures named in the done set are ignored, and ready ones are added to it.
+  A capture which changes again after it was yielded (for example, one which
+  was still being written, but paused for a whole poll) is yielded again once
+  it is ready. Returns once the sentinel file exists and every capture is done.
+  """
+  last_stats = {}
+  yielded_stats = {}
+  while True:
+    finished = os.path.exists(os.path.join(capture_dir, sentinel_filename))
+    ready = []
+    pending = 0
+    for filename in sorted(os.listdir(capture_dir)):
+      if not IsCapture(filename, reference_filename):
+        continue
+      if filename in done and filename not in yielded_stats:
+        continue
+      try:
+        stat = os.stat(os.path.join(capture_dir, filename))
+      except FileNotFoundError:
+        continue  # Removed or renamed since it was listed.
+      file_stats = (stat.st_size, stat.st_mtime)
+      if filename in done:
+        if yielded_stats[filename] == file_stats:
+          continue
+        done.discard(filename)
+        del yielded_stats[filename]
+      if stat.st_size and last_stats.get(filename) == file_stats:
+        ready.append(filename)
+        yielded_stats[filename] = file_stats
+      else:
+        last_stats[filename] = file_stats
+        pending += 1
+    if ready:
+      done.update(ready)
+      yield ready
+    elif finished and not pending:
+      return
+    else:
+      time.sleep(WATCH_POLL_SEC)
+
+
+class Throughput(object):
+  """Tracks images finished per second, for progress reports."""
+  def __init__(self, total):
+    self._total = total
+    self._done = 0
+    self._start = time.time()
+
+  def AddWork(self, count):
+    self._total += count
+
+  def Update(self):
+    self._done += 1
+
+  def __str__(self):
+    elapsed = time.time() - self._start
+    rate = self._done / elapsed if elapsed > 0 else 0.0
+    if rate > 0:
+      eta = '%d:%02d' % divmod(int((self._total - self._done) / rate), 60)
+    else:
+      eta = '?'
+    return '%.1f img/s, ETA %s' % (rate, eta)
+
+
+def SweepThresholds(crop_pool, diff_cache, raw_image_filenames, thresholds):
+  """Prints how many captures a die is found in, for each threshold.
+
+  Diffs are cached first for any captures which do not have them yet.
+  """
+  missing = [f for f in raw_image_filenames if f not in diff_cache.stored]
+  if missing:
+    print('Caching diffs for %d captures.' % len(missing))
+    throughput = Throughput(len(missing))
+    try:
+      for filename in crop_pool.Run('CacheDiff', missing):
+        diff_cache.MarkStored(filename)
+        throughput.Update()
+        print('%d/%d (%s) %s' % (
+            len(diff_cache.stored), len(raw_image_filenames), throughput,
+            filename))
+    finally:
+      diff_cache.Save()
+
+  found_counts = [0] * len(thresholds)
+  for found in crop_pool.Run(
+      'SweepThresholds', raw_image_filenames, thresholds):
+    for i, found_at_threshold in enumerate(found):
+      found_counts[i] += found_at_threshold
+  print('threshold  found  not found')
+  for threshold, found_count in zip(thresholds, found_counts):
+    print('%9d %6d %10d' % (
+        threshold, found_count, len(raw_image_filenames) - found_count))
+
+
+def LoadSampleDiffs(
+    capture_dir, reference_filename, raw_image_filenames,
+    analysis_resize_factor, draft, roi_path):
+  """Returns each capture's analysis-size diff against the reference, summed
+  across channels (see SumDiff), with any outside the region of interest zero.
+  """
+  unused_size, reference_pixels = LoadReference(
+      os.path.join(capture_dir, reference_filename),
+      analysis_resize_factor,
+      draft)
+  outside = None
+  if roi_path:
+    h, w = reference_pixels.shape[:2]
+    roi = RegionOfInterest.Load(roi_path, (w, h))
+    outside = numpy.ones((h, w), dtype=bool)
+    roi.Crop(outside)[:] = roi.outside
+  diff_sums = []
+  for raw_image_filename in raw_image_filenames:
+    unused_size, image, unused_full_image = OpenForAnalysis(
+        os.path.join(capture_dir, raw_image_filename),
+        analysis_resize_factor,
+        draft)
+    diff_sum = SumDiff(numpy.asarray(image), reference_pixels)
+    if outside is not None:
+      diff_sum[outside] = 0
+    diff_sums.append(diff_sum)
+  return diff_sums
+
+
+def OtsuThreshold(histogram):
+  """Returns the value best separating a histogram into two classes.
+
+  This is Otsu's method: the threshold maximizes the variance between the
+  classes of values at or below it and above it. Where several thresholds
+  do equally well (such as every value in an empty gap between the classes),
+  the middle one is taken. Raises NoDieFoundError if there is only one class.
+  """
+  histogram = numpy.asarray(histogram, dtype=numpy.float64)
+  values = numpy.arange(len(histogram))
+  below_count = numpy.cumsum(histogram)
+  below_sum = numpy.cumsum(histogram * values)
+  above_count = below_count[-1] - below_count
+  with numpy.errstate(divide='ignore', invalid='ignore'):
+    between_variance = (
+        below_count * above_count
+        * (below_sum / below_count
+           - (below_sum[-1] - below_sum) / above_count)**2)
+  between_variance = between_variance[:-1]
+  if numpy.all(numpy.isnan(between_variance)):
+    raise NoDieFoundError('All the diff values are the same.')
+  best = numpy.nanargmax(between_variance)
+  ties = between_variance[best:] == between_variance[best]
+  # The run of ties starting at the best, up to the first value which is not.
+  num_ties = len(ties) if ties.all() else numpy.argmin(ties)
+  return int(best + (num_ties - 1) // 2)
+
+
+def Calibrate(capture_dir, raw_image_filenames, args):
+  """Recommends crop parameters from a sample of captures.
+
+  The diff threshold first comes from Otsu's method on all the sample diffs,
+  and the die's size is the size of the largest region above that threshold,
+  taken at the 90th percentile of the sample so the crop fits most rolls.
+  Given the crop size and analysis resize factor that size calls for, a sweep
+  of thresholds around the first estimate settles on the middle of those
+  which find the most dice.
+
+  Returns a dict for CROP_CALIBRATION, with crop.py arguments under 'params'.
+  """
+  load_args = (capture_dir, args.reference, raw_image_filenames)
+  diff_sums = LoadSampleDiffs(
+      *load_args, args.analysis_resize_factor, args.draft, args.roi)
+  histogram = sum(
+      numpy.bincount(d.ravel(), minlength=3 * 256) for d in diff_sums)
+  otsu_threshold = OtsuThreshold(histogram)
+
+  die_sizes = []
+  for diff_sum in diff_sums:
+    num_labels, _, stats, _ = cv2.connectedComponentsWithStats(
+        (diff_sum > otsu_threshold).astype(numpy.uint8), connectivity=8)
+    if num_labels > 1:
+      largest = stats[1 + numpy.argmax(stats[1:, cv2.CC_STAT_AREA])]
+      die_sizes.append(args.analysis_resize_factor * max(
+          largest[cv2.CC_STAT_WIDTH], largest[cv2.CC_STAT_HEIGHT]))
+  if not die_sizes:
+    raise NoDieFoundError(
+        'Nothing differs from the reference above %d.' % otsu_threshold)
+  die_size = int(numpy.percentile(die_sizes, 90))
+  crop_size = 10 * int(math.ceil(CALIBRATE_CROP_MARGIN * die_size / 10.0))
+  analysis_resize_factor = max(
+      1, int(round(die_size / float(CALIBRATE_ANALYSIS_DIE_SIZE))))
+  print('Otsu threshold %d, die about %dpx: crop size %d, analysis resize '
+        % (otsu_threshold, die_size, crop_size)
+        + 'factor %d.' % analysis_resize_factor)
+
+  if analysis_resize_factor != args.analysis_resize_factor:
+    diff_sums = LoadSampleDiffs(
+        *load_args, analysis_resize_factor, args.draft, args.roi)
+  scan_distance = (2 * crop_size // 5) // analysis_resize_factor
+  # Always including the first estimate (at least 1), however small it is.
+  thresholds = sorted(set(range(
+      max(1, otsu_threshold // 2), 2 * otsu_threshold + 1,
+      max(1, otsu_threshold // 20))) | {max(1, otsu_threshold)})
+  found_counts = []
+  for threshold in thresholds:
+    found_count = 0
+    for diff_sum in diff_sums:
+      try:
+        found_count += len(TakeBounds(
+            IterComponentDiffBounds(diff_sum, scan_distance, threshold),
+            args.dice))
+      except NoDieFoundError:
+        pass
+    found_counts.append(found_count)
+  print('threshold  found')
+  for threshold, found_count in zip(thresholds, found_counts):
+    print('%9d %6d' % (threshold, found_count))
+  best = [
+      t for t, found_count in zip(thresholds, found_counts)
+      if found_count == max(found_counts)]
+  diff_threshold = best[len(best) // 2]
+
+  return {
+    'params': {
+      'diff_threshold': diff_threshold,
+      'crop_size': crop_size,
+      'analysis_resize_factor': analysis_resize_factor,
+    },
+    'sample': raw_image_filenames,
+    'die_size': die_size,
+    'found': max(found_counts),
+    'draft': args.draft,
+    'roi': args.roi,
+  }
+
+
+def ParseThresholdRange(range_str):
+  """Parses START:STOP:STEP (including STOP) into a list of thresholds."""
+  try:
+    start, stop, step = map(int, range_str.split(':'))
+  except ValueError:
+    raise argparse.ArgumentTypeError(
+        'Expected START:STOP:STEP, got %r.' % range_str)
+  if step < 1 or start < 1 or stop < start:
+    raise argparse.ArgumentTypeError('Bad threshold range %r.' % range_str)
+  return list(range(start, stop + 1, step))
 
 
 def SummarizeBounds(reference_filename, bounds_list, crop_summary_filename):
@@ -350,14 +1477,38 @@ def BuildArgParser():
               % DIFF_THRESHOLD_DEFAULT))
   parser.add_argument(
       '--force', '-f', action='store_true',
-      help='Overwrite existing crops.')
+      help='Overwrite existing crops. Otherwise, captures are skipped if their '
+           + 'result in the crop manifest is current: the capture is '
+           + 'unchanged, and it was cropped with the same parameters.')
+  parser.add_argument(
+      '--retry-failed', action='store_true', dest='retry_failed',
+      help='Only process captures where no die was found (or which have '
+           + 'changed), keeping existing crops even if they were made with '
+           + 'different parameters. Use when adjusting --diff-threshold.')
+  parser.add_argument(
+      '--summary-only', action='store_true', dest='summary_only',
+      help='Do not crop anything; draw the crop summary image from the bounds '
+           + 'recorded in the crop manifest.')
   parser.add_argument(
       '--number', '-n', type=int, default=0,
       help='Number of images to process (for example when debugging).')
   parser.add_argument(
       '--debug', action='store_true',
       help='Show debug images during processing. Use with -n to avoid showing '
-           + 'too many images.')
+           + 'too many images, and with -j 1 so images are shown.')
+  parser.add_argument(
+      '--jobs', '-j', type=int, default=multiprocessing.cpu_count(),
+      help='Number of worker processes. Default is the number of CPUs.')
+  parser.add_argument(
+      '--watch', '-w', action='store_true',
+      help='Keep running, and crop new captures as they are written (for '
+           + 'example while rolldie.py is still running). Stops once the '
+           + '--watch-sentinel file appears in the capture directory.')
+  parser.add_argument(
+      '--watch-sentinel', default='DONE', dest='watch_sentinel',
+      help='With --watch, create this file in the capture directory (for '
+           + 'example touch data/myd20/capture/DONE) after the last capture to '
+           + 'finish cropping and exit.')
   parser.add_argument(
       '--capture-dir', default='capture', dest='capture_dir',
       help='Subdirectory within the data directory containing raw input images '
@@ -381,6 +1532,83 @@ def BuildArgParser():
       default=6, type=int,
       help='Divisor for the image size. Source and reference will be resized '
            + 'during analysis/searching. (Output is crop-size.)')
+  parser.add_argument(
+      '--engine', '-e', choices=sorted(LOCALIZATION_ENGINES.keys()),
+      default=LOCALIZATION_ENGINE_DEFAULT,
+      help='How to search the diff for the die. "scan" walks scan lines and '
+           + 'flood-fills pixel by pixel; "components" finds the same bounds '
+           + 'using connected components over the whole thresholded diff, and '
+           + 'is much faster. Default %s.' % LOCALIZATION_ENGINE_DEFAULT)
+  parser.add_argument(
+      '--pyramid-factor', '-p', dest='pyramid_factor', type=int,
+      default=PYRAMID_FACTOR_DEFAULT,
+      help='First search a coarse diff, of blocks this many analysis pixels on '
+           + 'a side, for candidate regions; then search only around those at '
+           + 'analysis size. Falls back to searching the whole diff if fewer '
+           + 'than --dice dice are found that way. 1 always searches the whole '
+           + 'diff. Default %d.'
+           % PYRAMID_FACTOR_DEFAULT)
+  parser.add_argument(
+      '--draft', action='store_true',
+      help='Decode captures (and the reference) at reduced scale for analysis, '
+           + 'using JPEG DCT scaling, and decode at full resolution only to '
+           + 'crop out the die. Much faster; the diff is computed from '
+           + 'slightly different pixels, so --diff-threshold may need '
+           + 'adjustment.')
+  parser.add_argument(
+      '--crop-format', choices=CROP_FORMATS, default=CROP_FORMAT_DEFAULT,
+      dest='crop_format',
+      help='How to write crops. "jpeg" decodes the capture and re-encodes the '
+           + 'crop. "jpegtran" cuts the crop out of the capture without '
+           + 'recompressing it (moving it up to %dpx up and left to align '
+           % JPEG_BLOCK_SIZE
+           + 'with JPEG blocks), which is faster and adds no artifacts; it '
+           + 'requires the jpegtran program. "png" writes lossless PNG crops. '
+           + 'Default %s.' % CROP_FORMAT_DEFAULT)
+  parser.add_argument(
+      '--dice', type=int, default=1,
+      help='Number of dice rolled in each capture. Up to this many dice are '
+           + 'found (each a separate region of difference from the reference, '
+           + 'not overlapping the others), and each is cropped to its own file '
+           + 'suffixed _a, _b, and so on. Default 1, for no suffix.')
+  parser.add_argument(
+      '--roi',
+      help='Image marking the region of interest, the part of the frame where '
+           + 'the die may land (such as the tray). It is scaled to the capture '
+           + 'size. Black areas are never searched, and brighter areas are '
+           + 'searched first.')
+  parser.add_argument(
+      '--learn-roi', action='store_true', dest='learn_roi',
+      help='Write a region of interest image, %s in the data directory, from '
+           % CROP_ROI
+           + 'where dice were found in earlier runs (as recorded in the crop '
+           + 'manifest), and use it as --roi.')
+  parser.add_argument(
+      '--cache-diffs', action='store_true', dest='cache_diffs',
+      help='Keep the analysis-size diff of each capture in %s/ in the data '
+           % CROP_DIFF_CACHE
+           + 'directory, for --sweep-thresholds. Not with --watch; cache '
+           + 'diffs in a later run instead.')
+  parser.add_argument(
+      '--calibrate', action='store_true',
+      help='Do not crop anything. Estimate the die size and the diff '
+           + 'distribution from a sample of captures, and write recommended '
+           + '--diff-threshold, --crop-size and --analysis-resize-factor '
+           + 'values to %s in the data directory. Later runs use them as '
+           % CROP_CALIBRATION
+           + 'defaults (arguments given still take precedence).')
+  parser.add_argument(
+      '--calibrate-sample', type=int, default=CALIBRATE_SAMPLE_DEFAULT,
+      dest='calibrate_sample',
+      help='Number of captures, evenly spaced, to calibrate from. Default %d.'
+           % CALIBRATE_SAMPLE_DEFAULT)
+  parser.add_argument(
+      '--sweep-thresholds', type=ParseThresholdRange, dest='sweep_thresholds',
+      metavar='START:STOP:STEP',
+      help='Do not crop anything. Report how many captures a die is found in '
+           + 'for each of a range of --diff-threshold values (including STOP), '
+           + 'using cached diffs (see --cache-diffs) and caching any that are '
+           + 'missing. Uses the components engine.')
   return parser
 
 
@@ -389,65 +1617,183 @@ if __name__ == '__main__':
   args, positional = parser.parse_known_args()
   if len(positional) != 1:
     parser.error('A single argument for the data directory is required.')
+  if args.jobs < 1:
+    parser.error('--jobs must be at least 1.')
+  if args.calibrate_sample < 1:
+    parser.error('--calibrate-sample must be at least 1.')
+  if args.pyramid_factor < 1:
+    parser.error('--pyramid-factor must be at least 1.')
+  if not 1 <= args.dice <= DICE_MAX:
+    parser.error('--dice must be from 1 to %d.' % DICE_MAX)
+  if args.watch and args.number:
+    parser.error('--number cannot be used with --watch.')
+  if args.watch and args.cache_diffs:
+    # The cache has rows only for the captures present when it is opened.
+    parser.error('--cache-diffs cannot be used with --watch.')
+  if args.crop_format == 'jpegtran' and not shutil.which('jpegtran'):
+    parser.error('--crop-format=jpegtran requires jpegtran on the PATH.')
   data_dir = positional[0]
+  calibration_path = os.path.join(data_dir, CROP_CALIBRATION)
+  if not args.calibrate and os.path.isfile(calibration_path):
+    with open(calibration_path) as calibration_file:
+      calibrated_params = json.load(calibration_file)['params']
+    parser.set_defaults(**calibrated_params)
+    args, positional = parser.parse_known_args()
+    print('Using calibrated defaults from %s: %s' % (
+        calibration_path,
+        ', '.join('%s=%s' % (k, getattr(args, k))
+                  for k in sorted(calibrated_params))))
   capture_dir = os.path.join(data_dir, args.capture_dir)
   crop_dir = os.path.join(data_dir, args.crop_dir)
+  if args.calibrate:
+    captures = sorted(
+        f for f in os.listdir(capture_dir) if IsCapture(f, args.reference))
+    if not captures:
+      parser.error('No captures to calibrate from in %s.' % capture_dir)
+    sample = sorted(set(
+        captures[i] for i in numpy.linspace(
+            0, len(captures) - 1, args.calibrate_sample).astype(int)))
+    print('Calibrating from %d captures.' % len(sample))
+    try:
+      calibration = Calibrate(capture_dir, sample, args)
+    except NoDieFoundError as e:
+      parser.error('Calibration failed: %s' % e)
+    with open(calibration_path, 'w') as calibration_file:
+      json.dump(calibration, calibration_file, indent=2)
+    print('Wrote %s: %s' % (calibration_path, calibration['params']))
+    sys.exit(0)
   if not os.path.isdir(crop_dir):
     os.makedirs(crop_dir)
 
+  manifest = CropManifest(os.path.join(data_dir, CROP_MANIFEST))
   raw_image_names = os.listdir(capture_dir)
+  crop_summary_args = (
+      os.path.join(capture_dir, args.reference),
+      os.path.join(data_dir, 'cropsummary.jpg'))
+  if args.learn_roi:
+    learn_bounds = manifest.GetBounds(raw_image_names)
+    if len(learn_bounds) < ROI_LEARN_MIN_CROPS:
+      parser.error(
+          '--learn-roi needs at least %d crops in the manifest, found %d.'
+          % (ROI_LEARN_MIN_CROPS, len(learn_bounds)))
+    args.roi = os.path.join(data_dir, CROP_ROI)
+    LearnRegionOfInterest(
+        learn_bounds,
+        PIL.Image.open(crop_summary_args[0]).size,
+        args.crop_size // 2,
+        args.roi)
+    print('Wrote region of interest to %s.' % args.roi)
+  params = GetCropParams(args)
+  if args.summary_only:
+    SummarizeBounds(
+        crop_summary_args[0],
+        manifest.GetBounds(raw_image_names),
+        crop_summary_args[1])
+    sys.exit(0)
+
   n = len(raw_image_names)
   num_to_process = args.number if args.number > 0 else n
   processed = 0
   skipped = 0
   no_die_found_in = []
 
-  filename_queue = multiprocessing.Queue()
-  enqueued = 0
+  to_process = []
   for raw_image_name in raw_image_names:
-    if (raw_image_name.lower().endswith('jpg') and
-        raw_image_name.lower() != args.reference.lower()):
-      if os.path.isfile(os.path.join(crop_dir, raw_image_name)):
-        if not args.force:
-          processed += 1
-          skipped += 1
-          continue
-      filename_queue.put(raw_image_name)
-      enqueued += 1
-    if enqueued >= num_to_process:
+    if IsCapture(raw_image_name, args.reference):
+      if not args.force and manifest.IsDone(
+          raw_image_name, capture_dir, crop_dir, params, args.retry_failed):
+        processed += 1
+        skipped += 1
+        continue
+      to_process.append(raw_image_name)
+    if len(to_process) >= num_to_process:
       break
 
-  result_queue = multiprocessing.Queue()
-  pool = []
-  for _ in xrange(multiprocessing.cpu_count()):
-    pool.append(CropWorker(
-        filename_queue,
-        result_queue,
-        capture_dir,
-        crop_dir,
-        args.reference,
-        args.crop_size,
-        args.analysis_resize_factor,
-        args.diff_threshold,
-        args.debug))
-  for worker in pool:
-    worker.start()
-
-  filename_queue.close()  # no more data to be sent from this process
-  crop_bounds = []
-  try:
-    while any([worker.is_alive() for worker in pool]):
-      if not result_queue.empty():
-        processed += 1
-        r = result_queue.get_nowait()
-        print('%d/%d %s %s' % (
-            processed, n, r.filename, r.not_found_message or ''))
-        if r.not_found_message is not None:
-          no_die_found_in.append(r.filename)
-        else:
-          crop_bounds.append(r.crop_bounds)
-  except KeyboardInterrupt as e:
-    print('got ^C, early exit for crop')
+  full_size, reference_pixels = LoadReference(
+      os.path.join(capture_dir, args.reference),
+      args.analysis_resize_factor,
+      args.draft)
+  diff_cache = None
+  if args.cache_diffs or args.sweep_thresholds:
+    diff_cache = DiffCache(
+        os.path.join(data_dir, CROP_DIFF_CACHE),
+        {
+          'reference_sha1': _HashFile(crop_summary_args[0]),
+          'analysis_resize_factor': args.analysis_resize_factor,
+          'draft': args.draft,
+        },
+        sorted(f for f in raw_image_names if IsCapture(f, args.reference)),
+        reference_pixels.shape[:2])
+  crop_worker_args = (
+      capture_dir,
+      crop_dir,
+      args.crop_size,
+      args.analysis_resize_factor,
+      args.diff_threshold,
+      args.engine,
+      args.pyramid_factor,
+      args.draft,
+      args.crop_format,
+      args.roi,
+      args.dice,
+      diff_cache,
+      args.debug)
+  throughput = Throughput(0 if args.watch else len(to_process))
+  with CropPool(
+      args.jobs, full_size, reference_pixels, crop_worker_args) as crop_pool:
+    if args.sweep_thresholds:
+      try:
+        SweepThresholds(
+            crop_pool,
+            diff_cache,
+            sorted(f for f in raw_image_names if IsCapture(f, args.reference)),
+            args.sweep_thresholds)
+      except KeyboardInterrupt as e:
+        print('got ^C, stopping sweep')
+      sys.exit(0)
+    if args.watch:
+      # Captures already present may still be being written, so leave them to
+      # the watcher too.
+      n = processed
+      done = set()
+      if not args.force:
+        done.update(
+            raw_image_name for raw_image_name in raw_image_names
+            if IsCapture(raw_image_name, args.reference)
+            and manifest.IsDone(
+                raw_image_name, capture_dir, crop_dir, params,
+                args.retry_failed))
+      batches = WatchCaptures(
+          capture_dir, args.reference, args.watch_sentinel, done)
+      print('Watching %s, touch %s to finish.' % (
+          capture_dir, os.path.join(capture_dir, args.watch_sentinel)))
+    else:
+      batches = [to_process]
+    try:
+      for batch in batches:
+        if args.watch:
+          n += len(batch)
+          throughput.AddWork(len(batch))
+        for r in crop_pool.CropAll(batch):
+          processed += 1
+          throughput.Update()
+          manifest.Record(r._replace(params=params))
+          if diff_cache and not r.error:
+            diff_cache.MarkStored(r.filename)
+          found_message = r.not_found_message or ''
+          if r.region_bounds is not None and len(r.region_bounds) < args.dice:
+            found_message = 'found %d of %d dice' % (
+                len(r.region_bounds), args.dice)
+          print('%d/%d (%s) %s %s' % (
+              processed, n, throughput, r.filename, found_message))
+          if r.not_found_message is not None:
+            no_die_found_in.append(r.filename)
+          elif r.filename in no_die_found_in:
+            no_die_found_in.remove(r.filename)  # A rewritten, watched capture.
+    except KeyboardInterrupt as e:
+      print('got ^C, early exit for crop')
+    if diff_cache:
+      diff_cache.Save()
 
   print('Processed %d, skipped %d, die not found in %d @ threshold %d. %s' % (
       processed,
@@ -455,8 +1801,7 @@ if __name__ == '__main__':
       len(no_die_found_in),
       args.diff_threshold,
       no_die_found_in or ''))
+  # Summarize every crop so far, not just those from this run.
+  crop_bounds = manifest.GetBounds(os.listdir(capture_dir))
   if len(crop_bounds) > 10:
-    SummarizeBounds(
-        os.path.join(capture_dir, args.reference),
-        crop_bounds,
-        os.path.join(data_dir, 'cropsummary.jpg'))
+    SummarizeBounds(crop_summary_args[0], crop_bounds, crop_summary_args[1])
@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+"""Benchmark the crop stage (stage 1) on synthetic captures.
+
+Example:
+    %(prog)s --count 100 --draft
+
+Generates a capture set like one from rolldie.py: a reference image of an empty
+tray, and captures of a die sprite pasted at known positions and rotations,
+with lighting changes and sensor noise. Then crops every capture as crop.py
+does, and reports images per second, time spent in each phase (decode, resize,
+diff, search, crop, encode), and how far the found bounds are from the true
+ones.
+
+The captures are drawn with PIL and numpy, so no real captures are needed and
+results can be compared across machines and code changes. Options not listed
+here (such as --engine, --draft, --crop-format and --roi) are passed on as for
+crop.py.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import numpy
+
+import PIL
+import PIL.Image
+import PIL.ImageDraw
+import PIL.ImageFilter
+
+import crop
+
+
+DIE_COLORS = ((210, 30, 30), (30, 60, 220), (230, 200, 40), (240, 240, 240))
+PHASES = ('hash', 'decode', 'resize', 'diff', 'search', 'crop', 'encode')
+
+
+def MakeBackground(size, rng):
+  """Returns an empty tray: smooth low-contrast texture with a vignette."""
+  w, h = size
+  texture = rng.randint(90, 140, (h // 16, w // 16, 3)).astype(numpy.uint8)
+  background = PIL.Image.fromarray(texture).resize(
+      (w, h), PIL.Image.BICUBIC).filter(PIL.ImageFilter.GaussianBlur(4))
+  ys, xs = numpy.mgrid[-1:1:h * 1j, -1:1:w * 1j]
+  vignette = 1.0 - 0.25 * (xs**2 + ys**2)
+  return PIL.Image.fromarray(numpy.uint8(
+      numpy.asarray(background) * vignette[:, :, numpy.newaxis]))
+
+
+def MakeDieSprite(die_size, label, rng):
+  """Returns an RGBA image of a die face: a shaded polygon with a numeral."""
+  sprite = PIL.Image.new('RGBA', (die_size, die_size))
+  draw = PIL.ImageDraw.Draw(sprite)
+  center = die_size // 2
+  color = DIE_COLORS[rng.randint(0, len(DIE_COLORS))]
+  draw.regular_polygon(
+      (center, center, center - 2), 6, fill=color + (255,),
+      outline=tuple(c // 2 for c in color) + (255,), width=die_size // 40)
+  draw.regular_polygon(
+      (center, center, center // 2), 3,
+      fill=tuple(min(255, c + 40) for c in color) + (255,))
+  draw.text((center - 6, center - 6), str(label), fill=(255, 255, 255, 255))
+  return sprite
+
+
+def MakeCapture(background, sprites, positions, rng):
+  """Pastes rotated dice onto the background, with lighting noise.
+
+  Returns (capture, true_bounds), where the bounds are of each die's pixels.
+  """
+  capture = background.copy()
+  true_bounds = []
+  for sprite, (x, y) in zip(sprites, positions):
+    rotated = sprite.rotate(
+        rng.uniform(0, 360), resample=PIL.Image.BICUBIC, expand=True)
+    capture.paste(rotated, (x, y), rotated)
+    x_min, y_min, x_max, y_max = rotated.getchannel('A').getbbox()
+    true_bounds.append((x + x_min, y + y_min, x + x_max, y + y_max))
+  gain = rng.uniform(0.97, 1.03)
+  pixels = numpy.asarray(capture, dtype=numpy.float32) * gain
+  pixels += rng.normal(0.0, 2.0, pixels.shape)
+  capture = PIL.Image.fromarray(numpy.uint8(numpy.clip(pixels, 0, 255)))
+  return capture, true_bounds
+
+
+def PlaceDice(size, die_size, dice, rng):
+  """Returns a random top left corner for each die, spaced apart."""
+  w, h = size
+  margin = die_size // 2
+  # Leave room for the rotated sprite, which is up to sqrt(2) larger.
+  spacing = 2 * die_size
+  while True:
+    positions = list(zip(
+        rng.randint(margin, w - 3 * margin, dice).tolist(),
+        rng.randint(margin, h - 3 * margin, dice).tolist()))
+    if all(abs(ax - bx) > spacing or abs(ay - by) > spacing
+           for i, (ax, ay) in enumerate(positions)
+           for bx, by in positions[:i]):
+      return positions
+
+
+def WriteCaptureSet(
+    capture_dir, reference, count, size, die_size, dice, quality, seed):
+  """Writes a reference and count captures; returns {filename: true_bounds}.
+  """
+  rng = numpy.random.RandomState(seed)
+  background = MakeBackground(size, rng)
+  background.save(os.path.join(capture_dir, reference), quality=quality)
+  true_bounds = {}
+  for i in range(count):
+    sprites = [
+        MakeDieSprite(die_size, 1 + (i * dice + j) % 20, rng)
+        for j in range(dice)]
+    filename = '%05d.JPG' % i
+    capture, true_bounds[filename] = MakeCapture(
+        background, sprites, PlaceDice(size, die_size, dice, rng), rng)
+    capture.save(os.path.join(capture_dir, filename), quality=quality)
+  return true_bounds
+
+
+def CompareBounds(found, true):
+  """Returns (center distance in pixels, intersection over union)."""
+  found_center = numpy.array([found[0] + found[2], found[1] + found[3]]) / 2.0
+  true_center = numpy.array([true[0] + true[2], true[1] + true[3]]) / 2.0
+  intersection = (
+      max(0, min(found[2], true[2]) - max(found[0], true[0]))
+      * max(0, min(found[3], true[3]) - max(found[1], true[1])))
+  union = (
+      (found[2] - found[0]) * (found[3] - found[1])
+      + (true[2] - true[0]) * (true[3] - true[1])
+      - intersection)
+  return (
+      numpy.linalg.norm(found_center - true_center),
+      intersection / float(union) if union else 0.0)
+
+
+def IsInside(inner, outer):
+  return (inner[0] >= outer[0] and inner[1] >= outer[1]
+          and inner[2] <= outer[2] and inner[3] <= outer[3])
+
+
+def PrintReport(results, true_bounds, full_size, crop_size, elapsed, worker):
+  n = len(results)
+  num_dice = sum(len(b) for b in true_bounds.values())
+  # Each found bound is compared to the true bound it overlaps most.
+  distances, ious, inside = [], [], 0
+  for r in results:
+    for _, found_bound in crop.GetResultBounds(r):
+      true_bound = max(
+          true_bounds[r.filename],
+          key=lambda t: CompareBounds(found_bound, t)[1])
+      distance, iou = CompareBounds(found_bound, true_bound)
+      distances.append(distance)
+      ious.append(iou)
+      inside += IsInside(
+          true_bound, crop.MakeSquare(found_bound, full_size, crop_size))
+  print('%d images in %.1fs: %.2f img/s, found %d of %d dice (%d%%)' % (
+      n, elapsed, n / elapsed, len(ious), num_dice,
+      100 * len(ious) // max(1, num_dice)))
+  print('phase      ms/img')
+  for phase in PHASES:
+    print('%-8s %8.2f' % (
+        phase, 1000.0 * worker.timer.seconds[phase] / max(1, n)))
+  print('analysis pixels searched per image: %d (pyramid fell back %d times)'
+        % (worker.counts['searched_pixels'] // max(1, n),
+           worker.counts['pyramid_fallbacks']))
+  if not ious:
+    return
+  print('bounds error: center mean %.1fpx max %.1fpx, IoU mean %.3f min %.3f'
+        % (numpy.mean(distances), max(distances), numpy.mean(ious), min(ious)))
+  print('die entirely inside crop: %d/%d' % (inside, len(ious)))
+
+
+def BuildArgParser():
+  summary_line, _, main_doc = __doc__.partition('\n\n')
+  parser = argparse.ArgumentParser(
+      description=summary_line,
+      epilog=main_doc,
+      formatter_class=argparse.RawDescriptionHelpFormatter,
+      parents=[crop.BuildArgParser()],
+      conflict_handler='resolve')
+  parser.add_argument(
+      '--count', type=int, default=50,
+      help='Number of synthetic captures to generate.')
+  parser.add_argument(
+      '--size', type=int, nargs=2, default=(2592, 1944), metavar=('W', 'H'),
+      help='Capture size in pixels. The default matches rolldie.py.')
+  parser.add_argument(
+      '--die-size', type=int, default=460, dest='die_size',
+      help='Edge length of the (unrotated) die in pixels.')
+  parser.add_argument(
+      '--quality', type=int, default=85,
+      help='JPEG quality for the synthetic captures.')
+  parser.add_argument(
+      '--seed', type=int, default=0,
+      help='Random seed, so runs with the same options see the same captures.')
+  parser.add_argument(
+      '--keep',
+      help='Directory to write the synthetic data directory into, and keep. '
+           + 'By default a temporary directory is used and removed.')
+  return parser
+
+
+if __name__ == '__main__':
+  parser = BuildArgParser()
+  args = parser.parse_args()
+  data_dir = args.keep or tempfile.mkdtemp(prefix='crop_benchmark')
+  capture_dir = os.path.join(data_dir, args.capture_dir)
+  crop_dir = os.path.join(data_dir, args.crop_dir)
+  try:
+    for d in (capture_dir, crop_dir):
+      if not os.path.isdir(d):
+        os.makedirs(d)
+    print('Writing %d synthetic captures to %s.' % (args.count, capture_dir))
+    true_bounds = WriteCaptureSet(
+        capture_dir,
+        args.reference,
+        args.count,
+        tuple(args.size),
+        args.die_size,
+        args.dice,
+        args.quality,
+        args.seed)
+    with open(os.path.join(data_dir, 'true_bounds.json'), 'w') as true_file:
+      json.dump(true_bounds, true_file)
+
+    full_size, reference_pixels = crop.LoadReference(
+        os.path.join(capture_dir, args.reference),
+        args.analysis_resize_factor,
+        args.draft)
+    crop_worker_args = (
+        capture_dir,
+        crop_dir,
+        args.crop_size,
+        args.analysis_resize_factor,
+        args.diff_threshold,
+        args.engine,
+        args.pyramid_factor,
+        args.draft,
+        args.crop_format,
+        args.roi,
+        args.dice,
+        None,  # diff_cache
+        False)  # debug
+    filenames = sorted(true_bounds.keys())
+
+    # Phase timings come from cropping in this process.
+    crop_worker = crop.CropWorker(
+        full_size, reference_pixels, *crop_worker_args)
+    start = time.time()
+    results = [crop_worker.Crop(filename) for filename in filenames]
+    print('In one process:')
+    PrintReport(
+        results, true_bounds, full_size, args.crop_size, time.time() - start,
+        crop_worker)
+
+    if args.jobs > 1:
+      start = time.time()
+      with crop.CropPool(
+          args.jobs, full_size, reference_pixels, crop_worker_args) as pool:
+        for _ in pool.CropAll(filenames):
+          pass
+      elapsed = time.time() - start
+      print('With %d jobs: %.2f img/s' % (args.jobs, len(filenames) / elapsed))
+  finally:
+    if not args.keep:
+      shutil.rmtree(data_dir)
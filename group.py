@@ -6,14 +6,21 @@ Example:
 where there is a subdirectory data/myd20/crop/ containing extracted die images
 from stage 1.
 
-Send SIGHUP to render an intermediate summary image and show it.
+Send SIGHUP to render an intermediate summary image (in the background, while
+clustering continues) and show it.
+
+Features are extracted from the images in parallel (see --jobs), ahead of the
+clustering, which compares them one image at a time; each image's comparisons
+can be made in parallel too (see --match-jobs).
 
 On a 2.4GHz i5 MacBook Pro, this takes about 20 minutes for 3k images.
-TODO: Use multiprocessing.
 """
 
 import cv2
 import numpy
+import scipy
+import scipy.sparse
+import scipy.sparse.csgraph
 
 import PIL
 import PIL.Image
@@ -21,26 +28,162 @@ import PIL.ImageDraw
 
 import argparse
 import collections
+import hashlib
+import itertools
 import json
+import multiprocessing
 import os
 import random
 import signal
 import sys
+import tempfile
+import threading
+import time
 
 
 # Edge size for the otherwise unaltered image in the summary image.
 SUMMARY_MEMBER_IMAGE_SIZE = 90
 DETAIL_COLOR = (254, 0, 0)
+# How many summary images (thumbnails) to keep in memory, most recently used.
+THUMBNAIL_CACHE_SIZE = 1000
 IMAGE_SIZE_MAX = 65500  # hard limit imposed by PIL
+# With no --summary-max-members limit, clusters' images wrap onto further
+# rows of this many.
+SUMMARY_ROW_IMAGES = 50
+SUMMARY_PAGE_ROWS_DEFAULT = 100
+# How many images to send to a worker process at a time.
+EXTRACT_CHUNK_SIZE = 4
+FEATURE_STORE = 'groupfeatures'
+# How many features ORB (used by --cascade) keeps per image.
+ORB_FEATURES = 500
+# Identifies what each of FeatureComparison's detectors computes, for the
+# feature store.
+DETECTOR_CONFIGS = {
+  'akaze': 'akaze/opencv-%s' % cv2.__version__,
+  'orb': 'orb%d/opencv-%s' % (ORB_FEATURES, cv2.__version__),
+}
+FEATURE_CONFIG = DETECTOR_CONFIGS['akaze']
+# How to find each feature's nearest neighbors in the other image: brute force,
+# or with a FLANN locality sensitive hashing index of the other image's
+# descriptors (approximate, and built once per image).
+MATCHERS = ('bf', 'flann')
+MATCHER_DEFAULT = 'bf'
+FLANN_INDEX_LSH = 6
+FLANN_LSH_PARAMS = {'table_number': 6, 'key_size': 12, 'multi_probe_level': 1}
+# Identifies how FeatureComparison scores a pair of images (given the matcher's
+# name), for the pair score store. Scores from a different configuration are
+# kept in a different file.
+PAIR_SCORE_CONFIG = FEATURE_CONFIG + '/%s-knn2-ratio0.75-ransac5'
+# Visual words for --shortlist: how many, and how many images' descriptors to
+# cluster into words.
+VOCABULARY_SIZE = 256
+VOCABULARY_TRAIN_IMAGES = 100
+# Ways to form clusters: match each image against clusters found so far, or
+# match each image against its most similar images and take the connected
+# components of the graph of matches.
+CLUSTER_MODES = ('greedy', 'graph')
+# How many images' similarities RepresentativeIndex.GetNeighbors computes at a
+# time.
+NEIGHBOR_BLOCK_SIZE = 256
+# Radial intensity profiles for --prefilter: the image edge size they are
+# computed at, and the number of rings.
+SIGNATURE_IMAGE_SIZE = 64
+SIGNATURE_RINGS = 16
+# Pairs of images a MatchPool scores at a time, per worker process. Larger
+# batches keep workers busy, but waste more work after the first match.
+MATCH_BATCH_PER_JOB = 2
+# Images (with their features, and FLANN indexes) each MatchPool worker keeps.
+MATCH_WORKER_CACHE_SIZE = 256
+# How many matches to learn the prefilter's bound from before rejecting pairs.
+PREFILTER_WARMUP_MATCHES = 10
+# One record in the pair score store: the sha1 digests of the query image and
+# the image it was compared with, then the FeatureComparison scores.
+PAIR_SCORE_DTYPE = numpy.dtype([
+    ('query', numpy.uint8, 20),
+    ('train', numpy.uint8, 20),
+    ('match_count', numpy.int32),
+    ('scale_amount', numpy.float64),
+    ('feature_proportion', numpy.float64),
+])
 
 INF = float('Inf')
+EPSILON = 1e-6
+
+
+# An image's keypoint coordinates as an (N, 2) float32 array, and their
+# descriptors as an (N, descriptor bytes) uint8 array.
+ImageFeatures = collections.namedtuple(
+    'ImageFeatures', ('points', 'descriptors'))
+# ImageFeatures from a fast detector (ORB) and from the detector used for
+# final match decisions (AKAZE), for --cascade.
+CascadeFeatures = collections.namedtuple('CascadeFeatures', ('coarse', 'fine'))
+# What FeatureComparison._ScorePair finds for a pair of images:
+# (match_count, scale_amount) from ORB features with --cascade, else None;
+# (match_count, scale_amount, matches passing the ratio test) from AKAZE
+# features, or None if the cascade decided the pair; and (brute force
+# match_count, seconds, brute force seconds) with --matcher-report, else None.
+PairResult = collections.namedtuple('PairResult', ('coarse', 'fine', 'report'))
+# How many pips an image shows, and its summary image (with the pips
+# highlighted) as an array.
+PipCount = collections.namedtuple('PipCount', ('num_pips', 'summary_pixels'))
+
+
+class ThumbnailCache(object):
+  """Keeps the most recently used summary images, up to a fixed number.
+
+  With a directory, images are also saved there (as PNG, so they are the same
+  when read back) under a name given for each, such as the hash of the image
+  file they are made from, so later renders and runs skip decoding the full
+  images. Safe to use from the summary rendering thread and the main thread.
+  """
+  def __init__(self, size, cache_dir=None):
+    self._size = size
+    self._images = collections.OrderedDict()
+    self._cache_dir = cache_dir
+    self._lock = threading.Lock()
+    if cache_dir and not os.path.isdir(cache_dir):
+      os.makedirs(cache_dir)
+
+  def Get(self, key, make_image, disk_name=None):
+    """Returns the image for the key, calling make_image if it is not kept."""
+    with self._lock:
+      image = self._images.pop(key, None)
+    if image is None:
+      image = self._Load(disk_name, make_image)
+    with self._lock:
+      self._images[key] = image
+      while len(self._images) > self._size:
+        self._images.popitem(last=False)
+    return image
+
+  def _Load(self, disk_name, make_image):
+    if not (self._cache_dir and disk_name):
+      return make_image()
+    path = os.path.join(self._cache_dir, disk_name + '.png')
+    if os.path.isfile(path):
+      with PIL.Image.open(path) as cached_image:
+        cached_image.load()
+        return cached_image
+    image = make_image()
+    # Written under a temporary name, so a partial file is never read.
+    fd, temp_path = tempfile.mkstemp(suffix='.png', dir=self._cache_dir)
+    with os.fdopen(fd, 'wb') as temp_file:
+      image.save(temp_file, 'PNG')
+    os.replace(temp_path, path)
+    return image
 
 
 class _BaseImageComparison(object):
+  """An image of a die face. The image file is only opened when its pixels are
+  needed, and closed right after, so sessions of many images do not hold many
+  open files or decoded images.
+  """
+  __slots__ = ('in_filename', 'basename', 'is_representative', 'members')
+  _thumbnails = ThumbnailCache(THUMBNAIL_CACHE_SIZE)
+
   def __init__(self, in_filename):
+    self.in_filename = in_filename
     self.basename = os.path.basename(in_filename)
-    self.full_image = PIL.Image.open(in_filename)
-    self._summary_image = None  # lazily calculate a proxy res from full_image
 
     # Was this image ever a representative? Used when drawing the summary image.
     self.is_representative = False
@@ -49,10 +192,17 @@ class _BaseImageComparison(object):
 
   @property
   def summary_image(self):
-    if self._summary_image is None:
-      self._summary_image = self.full_image.resize(
+    return _BaseImageComparison._thumbnails.Get(
+        self.in_filename, self._MakeSummaryImage, self._GetThumbnailName())
+
+  def _GetThumbnailName(self):
+    """Returns a name for the summary image in the on-disk cache, or None."""
+    return None
+
+  def _MakeSummaryImage(self):
+    with PIL.Image.open(self.in_filename) as full_image:
+      return full_image.resize(
           (SUMMARY_MEMBER_IMAGE_SIZE, SUMMARY_MEMBER_IMAGE_SIZE))
-    return self._summary_image
 
   def _AddMember(self, image):
     self.members.append(image)
@@ -70,49 +220,282 @@ class FeatureComparison(_BaseImageComparison):
   Based on OpenCV's find_obj.py example, as in:
       find_obj.py --feature=akaze crop/DSC_0001.JPG crop/DSC_0002.JPG
   """
+  __slots__ = (
+      '_coarse_features',
+      '_features',
+      'sha1',
+      '_digest',
+      '_flann_matchers',
+      '_signature',
+      '_best_match',
+      '_best_match_count',
+      '_best_feature_proportion',
+      '_best_scale')
 
   # Feature type selection:
   # Brisk: faster, some false positive matches
   # Orb: faster, less accurate (inlier count less precise a threshold)
   # Akaze: slower, better threshold on inlier count v. match and not
-  _detector = cv2.AKAZE_create()
+  # With --cascade, ORB decides clear cases and AKAZE the rest.
+  _detectors = {
+    'akaze': cv2.AKAZE_create(),
+    'orb': cv2.ORB_create(ORB_FEATURES),
+  }
   _matcher = cv2.BFMatcher(cv2.NORM_HAMMING)
-
-  def __init__(self, in_filename):
+  # One of MATCHERS.
+  matcher = MATCHER_DEFAULT
+  # A PairScoreStore, if scores are to be kept across runs.
+  pair_scores = None
+  # A MatcherReport, to compare the matcher with brute force matching.
+  matcher_report = None
+  # A SignaturePrefilter, to skip matching pairs that look nothing alike.
+  prefilter = None
+  # A MatchCascade, to decide clear cases from ORB features (if images have
+  # CascadeFeatures).
+  cascade = None
+
+  def __init__(self, in_filename, features=None, sha1=None):
+    """Uses the given ImageFeatures (or CascadeFeatures), or else extracts
+    them (see Extract).
+
+    The sha1 of the image file identifies it in the pair score store.
+    """
     super(FeatureComparison, self).__init__(in_filename)
-
-    cv_image = cv2.imread(in_filename, 0)
-    if cv_image is None:
-      raise RuntimeError('OpenCV could not open %s' % in_filename)
-    self._features, self._descriptors = (
-        FeatureComparison._detector.detectAndCompute(cv_image, None))
-    if self._descriptors is None or not len(self._descriptors):
-      raise NoFeaturesError('No features in %s' % in_filename)
+    features = features or FeatureComparison.Extract(in_filename)[0]
+    self._coarse_features = None
+    if isinstance(features, CascadeFeatures):
+      self._coarse_features = CompactFeatures(features.coarse)
+      features = features.fine
+    self._features = CompactFeatures(features)
+    self.sha1 = sha1
+    self._digest = bytes.fromhex(sha1) if sha1 else None
+    self._flann_matchers = {}  # built when first matched against
+    self._signature = None  # lazily calculated from the image file
     self._best_match = None
     self._best_match_count = 0
     self._best_feature_proportion = INF
     self._best_scale = INF
 
-  def _GetMatchCount(self, other, verbose=True):
-    """Returns how many features match between this image and the other.
+  @staticmethod
+  def Extract(in_filename, detectors=('akaze',)):
+    """Detects features in an image, returning ImageFeatures per detector."""
+    cv_image = cv2.imread(in_filename, 0)
+    if cv_image is None:
+      raise RuntimeError('OpenCV could not open %s' % in_filename)
+    all_features = []
+    for detector in detectors:
+      keypoints, descriptors = (
+          FeatureComparison._detectors[detector].detectAndCompute(
+              cv_image, None))
+      if descriptors is None or not len(descriptors):
+        raise NoFeaturesError('No %s features in %s' % (detector, in_filename))
+      all_features.append(ImageFeatures(
+          numpy.float32([kp.pt for kp in keypoints]).reshape(-1, 2),
+          descriptors))
+    return tuple(all_features)
+
+  def _IterScores(self, others, verbose=True, match_pool=None):
+    """Yields (other, scores) for each of the other images, in order.
+
+    With a MatchPool, pairs which need matching are scored in batches across
+    its processes, ahead of being yielded. Otherwise each pair is scored when
+    reached. Scores (and prefilter and cascade decisions) are the same either
+    way, so the caller can stop at the first match.
+    """
+    batch_size = match_pool.batch_size if match_pool else 1
+    for start in range(0, len(others), batch_size):
+      batch = others[start:start + batch_size]
+      results = {}
+      if match_pool:
+        to_score = [other for other in batch if self._NeedsScoring(other)]
+        results = dict(zip(to_score, match_pool.ScorePairs(self, to_score)))
+      for other in batch:
+        yield other, self._GetScores(other, verbose, results.get(other))
+
+  def _GetStoredScores(self, other):
+    pair_scores = FeatureComparison.pair_scores
+    if pair_scores is None or not (self._digest and other._digest):
+      return None
+    return pair_scores.Get(self._digest, other._digest)
+
+  def _GetSignatureDistance(self, other):
+    return numpy.linalg.norm(self._GetSignature() - other._GetSignature())
+
+  def _NeedsScoring(self, other):
+    """Returns whether _GetScores will (likely) match features of the pair.
+
+    Pairs the prefilter rejects may still be audited; those are scored when
+    reached.
+    """
+    if self._GetStoredScores(other) is not None:
+      return False
+    prefilter = FeatureComparison.prefilter
+    return (prefilter is None
+            or prefilter.bound is None
+            or self._GetSignatureDistance(other) <= prefilter.bound)
+
+  def _GetScores(self, other, verbose=True, result=None):
+    """Returns (match_count, scale_amount, feature_proportion) for the pair.
+
+    Scores are taken from, or added to, the pair score store if there is one.
+    Otherwise the pair is scored, unless the prefilter rejects it, using the
+    given PairResult if it was already scored.
+    """
+    pair_scores = FeatureComparison.pair_scores
+    prefilter = FeatureComparison.prefilter
+    distance = None
+    if prefilter is not None:
+      distance = self._GetSignatureDistance(other)
+    scores = self._GetStoredScores(other)
+    if scores is not None:
+      if verbose:
+        print('%s match %s => %d inl / %.2f sh (stored)' % (
+            self.basename, other.basename, scores[0], scores[1]))
+      if prefilter is not None:
+        prefilter.Learn(distance, scores)
+      if FeatureComparison.cascade is not None:
+        FeatureComparison.cascade.Stored()
+      return scores
+    audited = False
+    if prefilter is not None:
+      admitted, audited = prefilter.Admit(distance)
+      if not admitted:
+        if verbose:
+          print('%s match %s => signature distance %.3f > %.3f (prefilter)' % (
+              self.basename, other.basename, distance, prefilter.bound))
+        return 0, INF, self._GetFeatureProportion(other)
+    result = result or self._ScorePair(other)
+    scores = self._RecordScores(other, result, verbose)
+    if result.fine is None:
+      return scores  # Decided by the cascade, not a full match.
+    if pair_scores is not None and self._digest and other._digest:
+      pair_scores.Put(self._digest, other._digest, scores)
+    if prefilter is not None:
+      prefilter.Learn(distance, scores, audited)
+    return scores
+
+  def _GetSignature(self):
+    """Returns the image's radial intensity profile (see RadialProfile)."""
+    if self._signature is None:
+      with PIL.Image.open(self.in_filename) as full_image:
+        self._signature = RadialProfile(full_image)
+    return self._signature
+
+  def _ScorePair(self, other):
+    """Matches features between this image and the other, returning a
+    PairResult.
+
+    This only depends on the two images' features, so pairs can be scored in
+    any process (see MatchPool).
+    """
+    matcher = FeatureComparison.matcher
+    cascade = FeatureComparison.cascade
+    coarse = None
+    if (cascade is not None
+        and self._coarse_features is not None
+        and other._coarse_features is not None):
+      match_count, scale_amount, _ = self._ScoreMatches(
+          other,
+          self._GetRawMatches(other, matcher, coarse=True),
+          coarse=True)
+      coarse = (match_count, scale_amount)
+      if cascade.Classify(match_count) is not None:
+        return PairResult(coarse, None, None)
+    start = time.time()
+    fine = self._ScoreMatches(other, self._GetRawMatches(other, matcher))
+    report = None
+    if FeatureComparison.matcher_report is not None and matcher != 'bf':
+      seconds = time.time() - start
+      start = time.time()
+      bf_match_count, _, _ = self._ScoreMatches(
+          other, self._GetRawMatches(other, 'bf'))
+      report = (bf_match_count, seconds, time.time() - start)
+    return PairResult(coarse, fine, report)
+
+  def _RecordScores(self, other, result, verbose=True):
+    """Returns scores for the pair from its PairResult.
+
+    Updates the cascade and matcher reports, in the order pairs are reached.
 
     Returns:
-      (match_count, scale_amount) as a tuple. The match count is the number of
-      matching features in the homography; that is, not only matching
-      individually but as a group. The scale amount is >= 1.0, and measures
-      how much the match is distorted as opposed to simply translated/rotated.
+      (match_count, scale_amount, feature_proportion) as a tuple. The match
+      count is the number of matching features in the homography; that is,
+      not only matching individually but as a group. The scale amount is
+      >= 1.0, and measures how much the match is distorted as opposed to simply
+      translated/rotated. See _GetFeatureProportion.
+    """
+    cascade = FeatureComparison.cascade
+    feature_proportion = self._GetFeatureProportion(other)
+    if result.coarse is not None:
+      coarse_match_count, coarse_scale_amount = result.coarse
+      is_match = cascade.Decide(coarse_match_count)
+      if is_match is not None:
+        if verbose:
+          print('%s match %s => %d orb inl / %.2f sh (cascade %s)' % (
+              self.basename,
+              other.basename,
+              coarse_match_count,
+              coarse_scale_amount,
+              'accept' if is_match else 'reject'))
+        # Clear accepts count as just enough AKAZE matches.
+        return (
+            cascade.match_threshold if is_match else 0,
+            coarse_scale_amount,
+            feature_proportion)
+    match_count, scale_amount, num_matches = result.fine
+    if result.report is not None:
+      FeatureComparison.matcher_report.Add(match_count, *result.report)
+    if verbose:
+      print('%s (%d) match %s (%d) = %d match => %s inl / %.2f sh' % (
+          self.basename,
+          len(self._features.points),
+          other.basename,
+          len(other._features.points),
+          num_matches,
+          match_count,
+          scale_amount))
+    if result.coarse is not None:
+      cascade.Escalated(coarse_match_count, match_count)
+    return int(match_count), scale_amount, feature_proportion
+
+  def _GetFeatures(self, coarse):
+    return self._coarse_features if coarse else self._features
+
+  def _GetRawMatches(self, other, matcher, coarse=False):
+    """Returns the two nearest neighbors in the other image of each feature.
+
+    With coarse, uses the (ORB) features for --cascade.
     """
-    raw_matches = FeatureComparison._matcher.knnMatch(
-        self._descriptors, trainDescriptors=other._descriptors, k=2)
-    p1, p2, matching_feature_pairs = self._FilterMatches(
-        self._features, other._features, raw_matches)
+    if matcher == 'bf':
+      return FeatureComparison._matcher.knnMatch(
+          self._GetFeatures(coarse).descriptors,
+          trainDescriptors=other._GetFeatures(coarse).descriptors,
+          k=2)
+    flann_matcher = other._flann_matchers.get(coarse)
+    if flann_matcher is None:
+      # The LSH tables are random; seeding makes each image's index the same
+      # whichever process builds it, and whatever was built before.
+      cv2.setRNGSeed(0)
+      flann_matcher = cv2.FlannBasedMatcher(
+          dict(algorithm=FLANN_INDEX_LSH, **FLANN_LSH_PARAMS), {})
+      flann_matcher.add([other._GetFeatures(coarse).descriptors])
+      flann_matcher.train()
+      other._flann_matchers[coarse] = flann_matcher
+    return flann_matcher.knnMatch(self._GetFeatures(coarse).descriptors, k=2)
+
+  def _ScoreMatches(self, other, raw_matches, coarse=False):
+    """Returns (match_count, scale_amount, matches passing the ratio test)."""
+    p1, p2 = self._FilterMatches(
+        self._GetFeatures(coarse).points,
+        other._GetFeatures(coarse).points,
+        raw_matches)
     match_count = 0
     scale_amount = INF
     if len(p1) >= 4:  # Otherwise not enough for homography estimation.
       homography_mat, inlier_pt_mask = cv2.findHomography(
           p1, p2, cv2.RANSAC, 5.0)
       if homography_mat is not None:
-        match_count = numpy.sum(inlier_pt_mask)
+        match_count = int(numpy.sum(inlier_pt_mask))
         # Sometimes matching faces are visible but the die is rotated. That is,
         # this die has 5 on top but 19 visible to the side, and the other die
         # has 19 on top but 5 visible. OpenCV may find a match, but the match
@@ -124,24 +507,15 @@ class FeatureComparison(_BaseImageComparison):
         if scale_amount < 1.0:
           scale_amount = (
               1.0 / scale_amount if scale_amount > 0 else INF)
-    if verbose:
-      print('%s (%d) match %s (%d) = %d match => %s inl / %.2f sh' % (
-          self.basename,
-          len(self._descriptors),
-          other.basename,
-          len(other._descriptors),
-          len(p1),
-          match_count,
-          scale_amount))
-    return match_count, scale_amount
+    return match_count, scale_amount, len(p1)
 
   def _GetFeatureProportion(self, other):
     """Returns the proportion of total features in this v. another image.
 
     This is always >= 1, and is infinity if either image has 0 features.
     """
-    a = float(len(other._features))
-    b = float(len(self._features))
+    a = float(len(other._features.points))
+    b = float(len(self._features.points))
     if not (a and b):
       return INF
     feature_proportion = a / b
@@ -156,43 +530,77 @@ class FeatureComparison(_BaseImageComparison):
       scale_threshold,
       feature_threshold,
       try_members=False):
+    return TakeIntoFirstMatch(
+        [self],
+        image,
+        match_threshold,
+        scale_threshold,
+        feature_threshold,
+        try_members=try_members) is not None
+
+  def _GetPotentialMatches(self, try_members):
+    """Returns this image, and with try_members some of its members.
+
+    The members are in the order _SortMembers will leave them.
+    """
     self_potential_matches = [self]
     if try_members:
       # Usually reparenting works within the first few tries if at all.
-      self.members.sort(key=lambda m: m._best_match_count)
-      self_potential_matches.extend(self.members[:10])
-    for self_potential_match in self_potential_matches:
-      match_count, scale_amount = image._GetMatchCount(
-          self_potential_match, verbose=not try_members)
-      feature_proportion = image._GetFeatureProportion(self_potential_match)
-      is_best = match_count > image._best_match_count
-      is_complete = (
-          match_count >= match_threshold
-          and scale_amount <= scale_threshold
-          and feature_proportion < feature_threshold)
-
-      if is_complete or is_best:
-        image._best_match = self_potential_match
-        image._best_match_count = match_count
-        image._best_feature_proportion = feature_proportion
-        image._best_scale = scale_amount
-        if is_complete:
-          self._AddMember(image)
-          print('%s matches %s%s => %d inl / %.2f scale' % (
-              image.basename,
-              self.basename,
-              '' if self_potential_match is self
-              else ' via ' + self_potential_match.basename,
-              match_count,
-              scale_amount))
-          return True
+      self_potential_matches.extend(
+          sorted(self.members, key=lambda m: m._best_match_count)[:10])
+    return self_potential_matches
+
+  def _SortMembers(self):
+    self.members.sort(key=lambda m: m._best_match_count)
+
+  def _TakeImageIfScores(
+      self,
+      image,
+      self_potential_match,
+      scores,
+      match_threshold,
+      scale_threshold,
+      feature_threshold):
+    """Takes the image as a member if its scores against this image (or the
+    potential match, one of its members) are a match. Returns whether it did.
+    """
+    match_count, scale_amount, feature_proportion = scores
+    is_best = match_count > image._best_match_count
+    is_complete = (
+        match_count >= match_threshold
+        and scale_amount <= scale_threshold
+        and feature_proportion < feature_threshold)
+
+    if is_complete or is_best:
+      image._SetBestMatch(self_potential_match, scores)
+      if is_complete:
+        self._AddMember(image)
+        print('%s matches %s%s => %d inl / %.2f scale' % (
+            image.basename,
+            self.basename,
+            '' if self_potential_match is self
+            else ' via ' + self_potential_match.basename,
+            match_count,
+            scale_amount))
+        return True
     return False
 
+  def _GetThumbnailName(self):
+    return self.sha1
+
+  def _SetBestMatch(self, other, scores):
+    """Records the other image and scores as this image's best match."""
+    self._best_match = other
+    (self._best_match_count,
+     self._best_scale,
+     self._best_feature_proportion) = scores
+
   def DrawOnSummary(self, draw, coords):
     x, y = coords
     draw.text((x, y), self.basename)
     draw.text(
-        (x, y + 10), 'features: %d' % len(self._features), DETAIL_COLOR)
+        (x, y + 10), 'features: %d' % len(self._features.points),
+        DETAIL_COLOR)
     draw.text(
         (x, y + 50), 'matches: %d' % self._best_match_count, DETAIL_COLOR)
     draw.text((x, y + 60), '  sh: %.2f' % self._best_scale, DETAIL_COLOR)
@@ -203,41 +611,192 @@ class FeatureComparison(_BaseImageComparison):
           (x, y + 80), '  %s' % self._best_match.basename, DETAIL_COLOR)
 
   @staticmethod
-  def _FilterMatches(features_a, features_b, raw_matches, ratio=0.75):
-    """Returns the subset of features which match between the two lists."""
-    matching_features_a, matching_features_b = [], []
-    for m in raw_matches:
-      if len(m) == 2 and m[0].distance < m[1].distance * ratio:
-        matching_features_a.append(features_a[m[0].queryIdx])
-        matching_features_b.append(features_b[m[0].trainIdx])
-    p1 = numpy.float32([kp.pt for kp in matching_features_a])
-    p2 = numpy.float32([kp.pt for kp in matching_features_b])
-    return p1, p2, zip(matching_features_a, matching_features_b)
+  def _FilterMatches(points_a, points_b, raw_matches, ratio=0.75):
+    """Returns the coordinates of features which match between the two images.
+    """
+    good_matches = [
+        m[0] for m in raw_matches
+        if len(m) == 2 and m[0].distance < m[1].distance * ratio]
+    p1 = points_a[numpy.array([m.queryIdx for m in good_matches], dtype=int)]
+    p2 = points_b[numpy.array([m.trainIdx for m in good_matches], dtype=int)]
+    return p1, p2
 
 
-class NoFeaturesError(RuntimeError):
-  """No features are detected in an image, rendering it unusable."""
-  pass
+def RadialProfile(image):
+  """Returns the mean brightness in rings about the image center.
+
+  This is a cheap, rotation invariant signature of a die face. The profile is
+  normalized (zero mean, unit length), so lighting changes matter less.
+  """
+  size = SIGNATURE_IMAGE_SIZE
+  pixels = numpy.asarray(
+      image.convert('L').resize((size, size), PIL.Image.BILINEAR),
+      dtype=numpy.float64)
+  ys, xs = numpy.mgrid[0:size, 0:size] + 0.5 - size / 2.0
+  rings = numpy.minimum(
+      (numpy.hypot(xs, ys) * 2.0 / size * SIGNATURE_RINGS).astype(int),
+      SIGNATURE_RINGS).ravel()
+  # The corners, outside the last full ring, are not included.
+  profile = (
+      numpy.bincount(rings, pixels.ravel(), SIGNATURE_RINGS + 1)
+      / numpy.bincount(rings, None, SIGNATURE_RINGS + 1))[:SIGNATURE_RINGS]
+  profile -= profile.mean()
+  length = numpy.linalg.norm(profile)
+  return profile / length if length > EPSILON else profile
+
+
+class SignaturePrefilter(object):
+  """Rejects pairs of images whose radial intensity profiles are far apart.
+
+  The bound on signature distance is learned from the pairs which match: it
+  is the largest distance seen for a match, times a margin. Until enough
+  matches are seen, every pair is admitted. Every so often a pair which would
+  be rejected is matched anyway (audited), to estimate how many pairs which
+  would match are rejected.
+  """
+  def __init__(
+      self,
+      margin,
+      audit_interval,
+      match_threshold,
+      scale_threshold,
+      feature_threshold):
+    self._margin = margin
+    self._audit_interval = audit_interval
+    self._thresholds = (match_threshold, scale_threshold, feature_threshold)
+    self._max_match_distance = 0.0
+    self._num_matches = 0
+    self.bound = None
+    self.counts = collections.Counter()
+
+  def Admit(self, distance):
+    """Returns whether to match a pair at the given signature distance, and
+    whether that is an audit of a pair which would be rejected.
+    """
+    self.counts['checked'] += 1
+    if self.bound is None or distance <= self.bound:
+      return True, False
+    self.counts['rejected'] += 1
+    if (self._audit_interval
+        and self.counts['rejected'] % self._audit_interval == 0):
+      self.counts['audited'] += 1
+      return True, True
+    return False, False
+
+  def Learn(self, distance, scores, audited=False):
+    """Updates the bound from the scores of a pair which was matched.
+
+    Pass audited for a pair admitted as an audit, to count it if it matches.
+    """
+    match_count, scale_amount, feature_proportion = scores
+    match_threshold, scale_threshold, feature_threshold = self._thresholds
+    if not (match_count >= match_threshold
+            and scale_amount <= scale_threshold
+            and feature_proportion < feature_threshold):
+      return
+    if audited:
+      self.counts['false_rejects'] += 1
+    self._num_matches += 1
+    self._max_match_distance = max(self._max_match_distance, distance)
+    if self._num_matches >= PREFILTER_WARMUP_MATCHES:
+      self.bound = self._max_match_distance * self._margin
+
+  def Print(self):
+    c = self.counts
+    print('prefilter: bound %s from %d matches; rejected %d of %d pairs '
+          '(%.1f%%)' % (
+              '%.3f' % self.bound if self.bound is not None else 'unset',
+              self._num_matches,
+              c['rejected'],
+              c['checked'],
+              100.0 * c['rejected'] / max(1, c['checked'])))
+    print('  audited %d rejects: %d would have matched (%.1f%% false rejects)'
+          % (c['audited'],
+             c['false_rejects'],
+             100.0 * c['false_rejects'] / max(1, c['audited'])))
+
+
+def CompactFeatures(features):
+  """Returns ImageFeatures as contiguous float32 points and uint8 descriptors.
+
+  Arrays which already are (such as views of the feature store's memory maps)
+  are not copied.
+  """
+  return ImageFeatures(
+      numpy.ascontiguousarray(features.points, dtype=numpy.float32),
+      numpy.ascontiguousarray(features.descriptors, dtype=numpy.uint8))
 
 
-class LabelDetail(object):
-  def __init__(self):
-    self._x = []
-    self._y = []
+class MatchCascade(object):
+  """Decides clear matches and non-matches from ORB features.
 
-  def Update(self, x, y):
-    self._x.append(x)
-    self._y.append(y)
+  Pairs with fewer than reject_below ORB inliers do not match, and pairs with
+  at least accept_from do (subject to the scale and feature thresholds). Only
+  pairs in between are escalated to matching AKAZE features, and how those
+  turn out is reported to help choose the band.
+  """
+  def __init__(self, reject_below, accept_from, match_threshold):
+    self._reject_below = reject_below
+    self._accept_from = accept_from
+    self.match_threshold = match_threshold
+    self.counts = collections.Counter()
+    # ORB inlier counts of escalated pairs AKAZE found to match, and not.
+    self._escalated_matches = []
+    self._escalated_non_matches = []
+
+  def Classify(self, coarse_match_count):
+    """Returns True (match), False (no match), or None to escalate."""
+    if coarse_match_count < self._reject_below:
+      return False
+    if coarse_match_count >= self._accept_from:
+      return True
+    return None
+
+  def Decide(self, coarse_match_count):
+    """Classifies the pair, and counts the decision for the report."""
+    is_match = self.Classify(coarse_match_count)
+    self.counts[{True: 'accepted', False: 'rejected', None: 'escalated'}[
+        is_match]] += 1
+    return is_match
+
+  def Stored(self):
+    """Counts a pair whose scores were stored, so it skipped the cascade."""
+    self.counts['stored'] += 1
+
+  def Escalated(self, coarse_match_count, match_count):
+    if match_count >= self.match_threshold:
+      self._escalated_matches.append(coarse_match_count)
+    else:
+      self._escalated_non_matches.append(coarse_match_count)
+
+  def Print(self):
+    c = self.counts
+    n = c['accepted'] + c['rejected'] + c['escalated']
+    if c['stored']:
+      print('cascade: %d pairs had stored akaze scores, and skipped the cascade'
+            % c['stored'])
+    if not n:
+      if not c['stored']:
+        print('cascade: no pairs compared')
+      return
+    print('cascade: of %d pairs, orb accepted %d and rejected %d; %d (%.1f%%) '
+          'escalated to akaze' % (
+              n,
+              c['accepted'],
+              c['rejected'],
+              c['escalated'],
+              100.0 * c['escalated'] / max(1, n)))
+    if self._escalated_matches:
+      print('  akaze matched %d escalated pairs, with orb inliers from %d' % (
+          len(self._escalated_matches), min(self._escalated_matches)))
+    if self._escalated_non_matches:
+      print('  akaze did not match %d, with orb inliers up to %d' % (
+          len(self._escalated_non_matches), max(self._escalated_non_matches)))
 
-  def GetCoords(self):
-    return list(zip(self._x, self._y))
 
-  def GetBounds(self):
-    return (
-        min(self._x) if self._x else INF,
-        min(self._y) if self._y else INF,
-        max(self._x) if self._x else -INF,
-        max(self._y) if self._y else -INF)
+class NoFeaturesError(RuntimeError):
+  """No features are detected in an image, rendering it unusable."""
+  pass
 
 
 PIP_THRESHOLD_ADJUST = -10  # more negative means pips shrink apart
@@ -246,9 +805,28 @@ PIP_AREA_PX_MAX = 1500
 BLACK_PIPS = True
 STRICT_PIPS = False
 class PipCounter(_BaseImageComparison):
-  def __init__(self, in_filename):
+  __slots__ = ('_num_pips',)
+
+  def __init__(self, in_filename, pip_count=None):
+    """Uses the given PipCount, or else counts pips (see Extract)."""
     super(PipCounter, self).__init__(in_filename)
+    pip_count = pip_count or PipCounter.Extract(in_filename)
+    self._num_pips = pip_count.num_pips
+    # The summary image, with pips highlighted, is made when counting. It is
+    # kept only in the thumbnail cache, like other summary images.
+    _BaseImageComparison._thumbnails.Get(
+        self.in_filename,
+        lambda: PIL.Image.fromarray(pip_count.summary_pixels))
+    print('%s = %d' % (self.basename, self._num_pips))
+
+  def _MakeSummaryImage(self):
+    # Once the summary image has left the cache, count again to remake it.
+    return PIL.Image.fromarray(
+        PipCounter.Extract(self.in_filename).summary_pixels)
 
+  @staticmethod
+  def Extract(in_filename):
+    """Counts the pips in an image, returning a PipCount."""
     img = cv2.imread(in_filename)
     gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
     threshold_mode = cv2.THRESH_BINARY_INV if BLACK_PIPS else cv2.THRESH_BINARY
@@ -269,44 +847,45 @@ class PipCounter(_BaseImageComparison):
         255,
         threshold_mode)
 
-    num_labels, labels = cv2.connectedComponents(
-        numpy.uint8(thresh))
-
-    # Dictionary lookups take nontrivial time here so use indices instead.
-    label_details = []
-
-    for i in xrange(num_labels + 1):
-      label_details.append(LabelDetail())
-    for y, row in enumerate(labels):
-      for x, label in enumerate(row):
-        label_details[label].Update(x, y)
+    num_labels, labels, stats, unused_centroids = (
+        cv2.connectedComponentsWithStats(numpy.uint8(thresh)))
+    areas = stats[:, cv2.CC_STAT_AREA]
+    # Extents are from the first to the last pixel (one less than the size).
+    widths = stats[:, cv2.CC_STAT_WIDTH] - 1.0
+    heights = stats[:, cv2.CC_STAT_HEIGHT] - 1.0
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+      eccentricities = heights / widths
+      eccentricities = numpy.where(
+          eccentricities < 1.0, 1.0 / eccentricities, eccentricities)
+      fill_proportions = areas / (heights * widths)
     # TODO Use convex hull or ellipse fit to determine which regions are pips on
     # the front face of the die.
     # http://docs.opencv.org/2.4/modules/imgproc/doc/structural_analysis_and_shape_descriptors.html
     # Simple label counting (excluding labels touching image edges) works for
     # regular pipped dice. Skew d6s show pips on the sides as well as fronts.
-    self._num_pips = 0
-    for label, detail in enumerate(label_details):
-      fill_color = None
-      coords = detail.GetCoords()
-      x_min, y_min, x_max, y_max = detail.GetBounds()
-      if len(coords) > 100:
-        e = float(y_max - y_min) / (x_max - x_min)
-        if e < 1.0:
-          e = 1.0 / e
-        fill_proportion = float(len(coords)) / (
-            (y_max - y_min) * (x_max - x_min))
-        if len(coords) > PIP_AREA_PX_MIN and len(coords) < PIP_AREA_PX_MAX:
-          fill_color = (254, 0, 0)
-          if not STRICT_PIPS or (e < 1.65 and fill_proportion > 0.68):
-            fill_color = (254, 254, 100)
-            self._num_pips += 1
-        print('%d\tpx=%d e=%.3f fill=%.3f %s' % (
-            label, len(coords), e, fill_proportion, fill_color))
-      if fill_color is not None:
-        for xy in coords:
-          self.full_image.putpixel(xy, fill_color)
-    print('%s = %d' % (self.basename, self._num_pips))
+    is_candidate = (areas > PIP_AREA_PX_MIN) & (areas < PIP_AREA_PX_MAX)
+    is_pip = is_candidate
+    if STRICT_PIPS:
+      is_pip = is_pip & (eccentricities < 1.65) & (fill_proportions > 0.68)
+    num_pips = int(numpy.count_nonzero(is_pip))
+    fill_colors = numpy.zeros((num_labels, 3), dtype=numpy.uint8)
+    fill_colors[is_candidate] = (254, 0, 0)
+    fill_colors[is_pip] = (254, 254, 100)
+    for label in numpy.flatnonzero(areas > 100):
+      print('%d\tpx=%d e=%.3f fill=%.3f %s' % (
+          label,
+          areas[label],
+          eccentricities[label],
+          fill_proportions[label],
+          tuple(fill_colors[label].tolist()) if is_candidate[label] else None))
+    # Draw the pips (and rejected candidates) on the image, by label.
+    with PIL.Image.open(in_filename) as full_image:
+      pixels = numpy.array(full_image.convert('RGB'))
+    is_filled = is_candidate[labels]
+    pixels[is_filled] = fill_colors[labels[is_filled]]
+    full_image = PIL.Image.fromarray(pixels)
+    return PipCount(num_pips, numpy.asarray(full_image.resize(
+        (SUMMARY_MEMBER_IMAGE_SIZE, SUMMARY_MEMBER_IMAGE_SIZE))))
 
   def TakeImageIfMatch(
       self,
@@ -327,33 +906,678 @@ class PipCounter(_BaseImageComparison):
         (x, y + 10), str(self._num_pips), DETAIL_COLOR)
 
 
+def ExtractImageData(in_filename_detectors):
+  """Extracts what clustering needs from an image of a die's face.
+
+  Takes the image filename, and the names of the feature detectors to run, or
+  None to count pips instead.
+
+  Returns:
+    (in_filename, image_data, error) where image_data is a PipCount or a tuple
+    of ImageFeatures (one per detector), or None with an error message if the
+    image is unusable.
+  """
+  in_filename, detectors = in_filename_detectors
+  try:
+    if detectors is None:
+      return in_filename, PipCounter.Extract(in_filename), None
+    return in_filename, FeatureComparison.Extract(in_filename, detectors), None
+  except (NoFeaturesError, cv2.error) as e:
+    return in_filename, None, str(e)
+
+
+def GetImageData(features_by_detector):
+  """Returns ImageFeatures, or CascadeFeatures if there are ORB features."""
+  if 'orb' in features_by_detector:
+    return CascadeFeatures(
+        features_by_detector['orb'], features_by_detector['akaze'])
+  return features_by_detector['akaze']
+
+
+def HashFile(path):
+  sha1 = hashlib.sha1()
+  with open(path, 'rb') as input_file:
+    for block in iter(lambda: input_file.read(1 << 20), b''):
+      sha1.update(block)
+  return sha1.hexdigest()
+
+
+class FeatureStore(object):
+  """ImageFeatures kept in the data directory across runs.
+
+  Features are keyed by the image file's content hash and the detector
+  configuration, so reruns (such as with a different --match-count-threshold)
+  skip detection. Points and descriptors are appended to two flat binary files,
+  and index.jsonl has a line per image locating its arrays in them. Features
+  from earlier runs are read through memory maps rather than loaded.
+  """
+  def __init__(self, store_dir, config):
+    if not os.path.isdir(store_dir):
+      os.makedirs(store_dir)
+    self._config = config
+    self._index_path = os.path.join(store_dir, 'index.jsonl')
+    self._paths = dict(
+        (name, os.path.join(store_dir, name + '.bin'))
+        for name in ('points', 'descriptors'))
+    self._maps = {}
+    self._index = {}
+    self._index_read_offset = 0
+    # Features stored by this run, which the memory maps do not cover.
+    self._new = {}
+    self.Refresh()
+
+  def Refresh(self):
+    """Reads index entries (and maps features) added since the last read, as
+    by another process's FeatureStore.
+    """
+    if not os.path.isfile(self._index_path):
+      return
+    with open(self._index_path) as index_file:
+      index_file.seek(self._index_read_offset)
+      for line in index_file:
+        if not line.endswith('\n'):
+          break  # Still being written.
+        self._index_read_offset += len(line)
+        if line.strip():
+          entry = json.loads(line)
+          if entry['config'] == self._config:
+            self._index[entry['sha1']] = entry
+    for name, path in self._paths.items():
+      if os.path.isfile(path) and os.path.getsize(path):
+        self._maps[name] = numpy.memmap(path, mode='r')
+
+  def __contains__(self, sha1):
+    return sha1 in self._index
+
+  def Load(self, sha1):
+    """Returns ImageFeatures, with arrays backed by the store's files."""
+    if sha1 in self._new:
+      return self._new[sha1]
+    entry = self._index[sha1]
+    count = entry['count']
+    points_start = entry['points_offset']
+    descriptors_start = entry['descriptors_offset']
+    descriptors_len = count * entry['descriptor_size']
+    return ImageFeatures(
+        self._maps['points'][points_start:points_start + count * 8]
+            .view(numpy.float32).reshape(count, 2),
+        self._maps['descriptors'][
+            descriptors_start:descriptors_start + descriptors_len]
+            .reshape(count, entry['descriptor_size']))
+
+  def Store(self, sha1, features):
+    """Appends an image's features. Arrays are written before the index, so an
+    interrupted write leaves at worst unindexed bytes.
+    """
+    entry = {
+      'sha1': sha1,
+      'config': self._config,
+      'count': len(features.points),
+      'descriptor_size': features.descriptors.shape[1],
+    }
+    for name, array in (
+        ('points', features.points), ('descriptors', features.descriptors)):
+      with open(self._paths[name], 'ab') as data_file:
+        entry[name + '_offset'] = data_file.tell()
+        data_file.write(numpy.ascontiguousarray(array).tobytes())
+    with open(self._index_path, 'a') as index_file:
+      index_file.write(json.dumps(entry) + '\n')
+    self._index[sha1] = entry
+    self._new[sha1] = features
+
+
+class PairScoreStore(object):
+  """FeatureComparison scores for pairs of images, kept across runs.
+
+  Records of PAIR_SCORE_DTYPE, keyed by the two images' content hashes, are
+  appended to a flat binary file as each pair is scored, so changing a
+  threshold and re-clustering only scores pairs not compared before.
+  """
+  def __init__(self, path):
+    self._scores = {}
+    if os.path.isfile(path):
+      raw = numpy.fromfile(path, dtype=numpy.uint8)
+      num_records = len(raw) // PAIR_SCORE_DTYPE.itemsize
+      if len(raw) % PAIR_SCORE_DTYPE.itemsize:
+        # An interrupted write; drop it so new records line up.
+        os.truncate(path, num_records * PAIR_SCORE_DTYPE.itemsize)
+      records = raw[:num_records * PAIR_SCORE_DTYPE.itemsize].view(
+          PAIR_SCORE_DTYPE)
+      for record in records:
+        self._scores[(record['query'].tobytes(), record['train'].tobytes())] = (
+            int(record['match_count']),
+            float(record['scale_amount']),
+            float(record['feature_proportion']))
+    self._path = path
+
+  def __len__(self):
+    return len(self._scores)
+
+  def Get(self, query_digest, train_digest):
+    return self._scores.get((query_digest, train_digest))
+
+  def Put(self, query_digest, train_digest, scores):
+    self._scores[(query_digest, train_digest)] = scores
+    record = numpy.zeros(1, dtype=PAIR_SCORE_DTYPE)
+    record['query'] = numpy.frombuffer(query_digest, dtype=numpy.uint8)
+    record['train'] = numpy.frombuffer(train_digest, dtype=numpy.uint8)
+    match_count, scale_amount, feature_proportion = scores
+    record['match_count'] = match_count
+    record['scale_amount'] = scale_amount
+    record['feature_proportion'] = feature_proportion
+    with open(self._path, 'ab') as scores_file:
+      scores_file.write(record.tobytes())
+
+
+class MatcherReport(object):
+  """Compares inlier counts from the chosen matcher with brute force."""
+  def __init__(self):
+    self._match_counts = []
+    self._bf_match_counts = []
+    self._seconds = 0.0
+    self._bf_seconds = 0.0
+
+  def Add(self, match_count, bf_match_count, seconds, bf_seconds):
+    self._match_counts.append(match_count)
+    self._bf_match_counts.append(bf_match_count)
+    self._seconds += seconds
+    self._bf_seconds += bf_seconds
+
+  def Print(self, matcher, match_threshold):
+    n = len(self._match_counts)
+    if not n:
+      print('matcher report: no pairs compared')
+      return
+    match_counts = numpy.array(self._match_counts, dtype=int)
+    bf_match_counts = numpy.array(self._bf_match_counts, dtype=int)
+    differences = match_counts - bf_match_counts
+    accepted = match_counts >= match_threshold
+    bf_accepted = bf_match_counts >= match_threshold
+    print('matcher report: %d pairs, %s %.2f ms/pair, bf %.2f ms/pair' % (
+        n, matcher, 1000.0 * self._seconds / n, 1000.0 * self._bf_seconds / n))
+    print('  inliers %s - bf: mean %.2f, median %.1f, max |difference| %d' % (
+        matcher,
+        differences.mean(),
+        numpy.median(differences),
+        numpy.abs(differences).max()))
+    print('  at match threshold %d: %d pairs accepted only by %s, %d only by '
+          'bf (of %d accepted by bf)' % (
+              match_threshold,
+              numpy.sum(accepted & ~bf_accepted),
+              matcher,
+              numpy.sum(~accepted & bf_accepted),
+              numpy.sum(bf_accepted)))
+
+
+def GetMatcherConfig(matcher):
+  """Returns a name for the matcher, including any parameters."""
+  if matcher == 'flann':
+    return 'flann-lsh-%(table_number)d-%(key_size)d-%(multi_probe_level)d' % (
+        FLANN_LSH_PARAMS)
+  return matcher
+
+
+def GetStorePath(store_dir, filename, config):
+  """Returns the path in the store for a file specific to a configuration.
+
+  For example, pairscores.bin becomes pairscores-<hash of config>.bin.
+  """
+  base, extension = os.path.splitext(filename)
+  return os.path.join(store_dir, '%s-%s%s' % (
+      base, hashlib.sha1(config.encode()).hexdigest()[:12], extension))
+
+
+def IterImageData(
+    extraction_pool, in_filenames, detectors, feature_stores,
+    extract_missing=True):
+  """Yields (in_filename, sha1, image_data, error) for each image, in order.
+
+  Image data is a PipCount if detectors is None, else ImageFeatures or
+  CascadeFeatures (see GetImageData). With a FeatureStore for each detector,
+  each image's sha1 is given, and stored features are used instead of
+  detecting them again; only missing detectors are run. Newly extracted
+  features are added to the stores, unless extract_missing is false: then
+  images without stored features are reported as errors.
+  """
+  if not feature_stores:
+    for in_filename, image_data, error in extraction_pool.Extract(
+        [(in_filename, detectors) for in_filename in in_filenames]):
+      if image_data is not None and detectors is not None:
+        image_data = GetImageData(dict(zip(detectors, image_data)))
+      yield in_filename, None, image_data, error
+    return
+  hashes = [HashFile(in_filename) for in_filename in in_filenames]
+  missing = [
+      tuple(d for d in detectors if sha1 not in feature_stores[d])
+      for sha1 in hashes]
+  print('Features for %d of %d images are stored.' % (
+      sum(not m for m in missing), len(in_filenames)))
+  extracted = iter([])
+  if extract_missing:
+    extracted = extraction_pool.Extract([
+        (in_filename, missing_detectors)
+        for in_filename, missing_detectors in zip(in_filenames, missing)
+        if missing_detectors])
+  for in_filename, sha1, missing_detectors in zip(
+      in_filenames, hashes, missing):
+    features_by_detector = {}
+    if missing_detectors:
+      if not extract_missing:
+        yield (
+            in_filename, sha1, None, 'No stored features for %s' % in_filename)
+        continue
+      unused_in_filename, all_features, error = next(extracted)
+      if error is not None:
+        yield in_filename, sha1, None, error
+        continue
+      for detector, features in zip(missing_detectors, all_features):
+        if sha1 not in feature_stores[detector]:
+          feature_stores[detector].Store(sha1, features)
+        features_by_detector[detector] = features
+    for detector in detectors:
+      if detector not in features_by_detector:
+        features_by_detector[detector] = feature_stores[detector].Load(sha1)
+    yield in_filename, sha1, GetImageData(features_by_detector), None
+
+
+def TrainVocabulary(descriptor_arrays, size):
+  """Clusters binary descriptors into visual words.
+
+  Descriptors are unpacked to one float per bit for k-means, and the resulting
+  centers are rounded back to binary, so words are assigned by Hamming
+  distance like any other descriptor match.
+
+  Returns:
+    (size, descriptor bytes) uint8 array of the words' descriptors.
+  """
+  bits = numpy.unpackbits(
+      numpy.concatenate(descriptor_arrays), axis=1).astype(numpy.float32)
+  size = min(size, len(bits))
+  cv2.setRNGSeed(0)  # so reruns get the same words
+  _, _, centers = cv2.kmeans(
+      bits,
+      size,
+      None,
+      (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 20, 0.5),
+      1,
+      cv2.KMEANS_PP_CENTERS)
+  return numpy.packbits(centers > 0.5, axis=1)
+
+
+def LoadVocabulary(vocabulary_path, descriptor_arrays):
+  """Returns the vocabulary saved at the path, or trains and saves one.
+
+  With no path, always trains a vocabulary.
+  """
+  if vocabulary_path and os.path.isfile(vocabulary_path):
+    return numpy.load(vocabulary_path)
+  print('Training %d visual words from %d images.' % (
+      VOCABULARY_SIZE, len(descriptor_arrays)))
+  vocabulary = TrainVocabulary(descriptor_arrays, VOCABULARY_SIZE)
+  if vocabulary_path:
+    numpy.save(vocabulary_path, vocabulary)
+  return vocabulary
+
+
+class RepresentativeIndex(object):
+  """Ranks cluster representatives (or, for --cluster graph, all images) by
+  visual-word similarity to an image.
+
+  Each image's descriptors are quantized to their nearest visual word, and
+  images are compared by the cosine of their tf-idf weighted word histograms.
+  The index is a row of word counts per representative; with the tens to
+  hundreds of representatives of a die, scoring every row with numpy is
+  cheaper than walking posting lists.
+  """
+  def __init__(self, vocabulary):
+    self._vocabulary = vocabulary
+    self._matcher = cv2.BFMatcher(cv2.NORM_HAMMING)
+    self._representatives = []
+    self._rows = []
+    self._weights = None  # (idf, normalized weights), until the next Add
+
+  def _GetWordCounts(self, image):
+    matches = self._matcher.match(
+        numpy.ascontiguousarray(image._features.descriptors),
+        self._vocabulary)
+    return numpy.bincount(
+        [m.trainIdx for m in matches], minlength=len(self._vocabulary)
+        ).astype(numpy.float32)
+
+  def Add(self, representative):
+    self._representatives.append(representative)
+    self._rows.append(self._GetWordCounts(representative))
+    self._weights = None
+
+  def _GetWeights(self):
+    """Returns (idf, tf-idf weights with a unit length row per image)."""
+    if self._weights is None:
+      counts = numpy.vstack(self._rows)
+      document_frequency = numpy.count_nonzero(counts, axis=0)
+      idf = numpy.log(
+          (1.0 + len(self._representatives)) / (1.0 + document_frequency))
+      weights = counts * idf
+      weights /= numpy.maximum(
+          EPSILON, numpy.linalg.norm(weights, axis=1))[:, numpy.newaxis]
+      self._weights = idf, weights
+    return self._weights
+
+  def Shortlist(self, image, length):
+    """Returns the length representatives most similar to the image."""
+    if len(self._representatives) <= length:
+      return list(self._representatives)
+    idf, weights = self._GetWeights()
+    query = self._GetWordCounts(image) * idf
+    scores = weights.dot(query / max(EPSILON, numpy.linalg.norm(query)))
+    return [
+        self._representatives[i]
+        for i in numpy.argsort(-scores, kind='stable')[:length]]
+
+  def GetNeighbors(self, length):
+    """Returns the indexes (in the order added) of the length other images
+    most similar to each image in the index.
+    """
+    _, weights = self._GetWeights()
+    neighbors = []
+    for start in range(0, len(weights), NEIGHBOR_BLOCK_SIZE):
+      block = weights[start:start + NEIGHBOR_BLOCK_SIZE]
+      scores = block.dot(weights.T)
+      rows = numpy.arange(len(block))
+      scores[rows, start + rows] = -INF  # Not the image itself.
+      neighbors.extend(
+          numpy.argsort(-scores, axis=1, kind='stable')[:, :length].tolist())
+    return neighbors
+
+
+def _InitExtractionWorker():
+  signal.signal(signal.SIGINT, signal.SIG_IGN)  # The parent handles ^C.
+
+
+class ExtractionPool(object):
+  """Runs ExtractImageData in a pool of processes, ahead of clustering.
+
+  Results are yielded in input order, so clustering is the same as with one
+  job, which runs everything in this process instead. Use as a context
+  manager; leaving it stops the workers.
+  """
+  def __init__(self, jobs):
+    self._pool = None
+    if jobs > 1:
+      self._pool = multiprocessing.Pool(jobs, _InitExtractionWorker)
+
+  def Extract(self, items):
+    """Yields the ExtractImageData result for each (in_filename, detectors)."""
+    if self._pool:
+      return self._pool.imap(ExtractImageData, items, EXTRACT_CHUNK_SIZE)
+    return map(ExtractImageData, items)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *unused_exc_info):
+    if self._pool:
+      # Any work still queued is for an interrupted run, so drop it.
+      self._pool.terminate()
+      self._pool.join()
+
+
+class _MatchWorker(object):
+  """Scores pairs of images in a MatchPool process.
+
+  Features are read through memory maps of the feature stores, so only the
+  images' filenames and hashes are sent to the process. Recently used images
+  are kept, with any FLANN indexes built for them.
+  """
+  def __init__(self, feature_stores):
+    self._feature_stores = feature_stores
+    self._images = collections.OrderedDict()
+
+  def _GetImage(self, in_filename, sha1):
+    image = self._images.pop(sha1, None)
+    if image is None:
+      features_by_detector = {}
+      for detector, feature_store in self._feature_stores.items():
+        if sha1 not in feature_store:
+          feature_store.Refresh()
+        features_by_detector[detector] = feature_store.Load(sha1)
+      image = FeatureComparison(
+          in_filename, GetImageData(features_by_detector), sha1)
+      if len(self._images) >= MATCH_WORKER_CACHE_SIZE:
+        self._images.popitem(last=False)
+    self._images[sha1] = image
+    return image
+
+  def ScorePair(self, query_key, train_key):
+    return self._GetImage(*query_key)._ScorePair(self._GetImage(*train_key))
+
+
+_match_worker = None
+
+
+def _InitMatchWorker(store_dir, detectors, matcher, cascade, matcher_report):
+  global _match_worker
+  signal.signal(signal.SIGINT, signal.SIG_IGN)  # The parent handles ^C.
+  FeatureComparison.matcher = matcher
+  FeatureComparison.cascade = cascade
+  if matcher_report:
+    FeatureComparison.matcher_report = MatcherReport()
+  _match_worker = _MatchWorker(dict(
+      (detector, FeatureStore(store_dir, DETECTOR_CONFIGS[detector]))
+      for detector in detectors))
+
+
+def _ScorePairInWorker(keys):
+  return _match_worker.ScorePair(*keys)
+
+
+class MatchPool(object):
+  """Scores batches of pairs of FeatureComparison images in a pool of
+  processes, reading features from the feature store.
+
+  Configure FeatureComparison (matcher, cascade and matcher report) before
+  starting the pool. With one job there is no pool, and pairs are scored as
+  they are reached instead. Use as a context manager; leaving it stops the
+  workers.
+  """
+  def __init__(self, jobs, store_dir=None, detectors=('akaze',)):
+    self._pool = None
+    self.batch_size = jobs * MATCH_BATCH_PER_JOB
+    if jobs > 1:
+      self._pool = multiprocessing.Pool(
+          jobs,
+          _InitMatchWorker,
+          (store_dir,
+           detectors,
+           FeatureComparison.matcher,
+           FeatureComparison.cascade,
+           FeatureComparison.matcher_report is not None))
+
+  def __bool__(self):
+    return self._pool is not None
+
+  def ScorePairs(self, image, others):
+    """Returns a PairResult for the image against each of the others."""
+    if not others:
+      return []
+    key = (image.in_filename, image.sha1)
+    return self._pool.map(
+        _ScorePairInWorker,
+        [(key, (other.in_filename, other.sha1)) for other in others])
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *unused_exc_info):
+    if self._pool:
+      self._pool.terminate()
+      self._pool.join()
+
+
+def TakeIntoFirstMatch(
+    representatives,
+    image,
+    match_threshold,
+    scale_threshold,
+    feature_threshold,
+    try_members=False,
+    match_pool=None):
+  """Adds the image as a member of the first representative it matches.
+
+  Returns that representative, or None if none match. With try_members, some
+  members of each representative are tried too (see TakeImageIfMatch). For
+  FeatureComparison images, a MatchPool scores the pairs in batches; the
+  first match is the same as when scoring one pair at a time.
+  """
+  if not isinstance(image, FeatureComparison):
+    for representative in representatives:
+      if representative.TakeImageIfMatch(
+          image, match_threshold, scale_threshold, feature_threshold,
+          try_members=try_members):
+        return representative
+    return None
+  potential_matches = [
+      (representative, potential_match)
+      for representative in representatives
+      for potential_match in representative._GetPotentialMatches(try_members)]
+  scores_iter = image._IterScores(
+      [potential_match for _, potential_match in potential_matches],
+      verbose=not try_members,
+      match_pool=match_pool)
+  for (representative, potential_match), (_, scores) in zip(
+      potential_matches, scores_iter):
+    if try_members and potential_match is representative:
+      # Sorted as the representative is reached, as ties are left in order.
+      representative._SortMembers()
+    if representative._TakeImageIfScores(
+        image,
+        potential_match,
+        scores,
+        match_threshold,
+        scale_threshold,
+        feature_threshold):
+      return representative
+  return None
+
+
 def AssignToCluster(
     in_filename,
+    sha1,
+    image_data,
     representatives,
     match_threshold,
     scale_threshold,
     feature_threshold,
-    count_pips):
-  """Reads an image of a die's face and assigns it to a group where it matches.
-
-  The input representatives list is modified. It stores a list of representative
-  images. Each additional image is either added as a member of the first
-  representative where it matches the sufficiently; or it starts a new cluster.
+    representative_index=None,
+    shortlist=0,
+    match_pool=None):
+  """Assigns an image of a die's face to a group where it matches.
+
+  The image_data is from ExtractImageData, and the sha1 of the image file may
+  be None (see FeatureComparison). The input representatives list is
+  modified. It stores a list of representative images. Each additional image is
+  either added as a member of the first representative where it matches the
+  sufficiently; or it starts a new cluster.
+
+  With a RepresentativeIndex, only the shortlist representatives it ranks most
+  similar to the image are tried (still in list order), and new
+  representatives are added to it. A MatchPool scores pairs in parallel (see
+  TakeIntoFirstMatch).
   """
   image = (
-      PipCounter(in_filename) if count_pips else
-      FeatureComparison(in_filename))
-  for representative in representatives:
-    if representative.TakeImageIfMatch(
-        image, match_threshold, scale_threshold, feature_threshold):
-      return
+      PipCounter(in_filename, image_data)
+      if isinstance(image_data, PipCount) else
+      FeatureComparison(in_filename, image_data, sha1))
+  candidates = representatives
+  if representative_index is not None:
+    shortlisted = set(representative_index.Shortlist(image, shortlist))
+    candidates = [r for r in representatives if r in shortlisted]
+  if TakeIntoFirstMatch(
+      candidates,
+      image,
+      match_threshold,
+      scale_threshold,
+      feature_threshold,
+      match_pool=match_pool):
+    return
   print('starts new cluster')
   image.is_representative = True
   representatives.append(image)
+  if representative_index is not None:
+    representative_index.Add(image)
+
+
+def ClusterGraph(
+    images,
+    match_threshold,
+    scale_threshold,
+    feature_threshold,
+    representative_index,
+    num_candidates,
+    match_pool=None):
+  """Clusters FeatureComparison images by matching each with similar images.
+
+  Each image is matched against the num_candidates images the
+  RepresentativeIndex (holding all the images, in order) ranks most similar.
+  Each pair is scored once, with the later image of the two as the query.
+  Matching pairs are the edges of a graph, and its connected components are
+  the clusters, so the result does not depend on the order the images are
+  read in, only on their order in the list.
+
+  Returns representatives as AssignToCluster builds them: for each cluster,
+  largest first, the image with the most matches (then the earliest) with the
+  others as members in order.
+  """
+  neighbors = representative_index.GetNeighbors(num_candidates)
+  trains_by_query = collections.defaultdict(set)
+  for i, image_neighbors in enumerate(neighbors):
+    for j in image_neighbors:
+      trains_by_query[max(i, j)].add(min(i, j))
+  num_pairs = sum(len(trains) for trains in trains_by_query.values())
+  print('graph: scoring %d pairs of %d images' % (num_pairs, len(images)))
+  edges = []
+  try:
+    for query in sorted(trains_by_query):
+      trains = sorted(trains_by_query[query])
+      scores_iter = images[query]._IterScores(
+          [images[train] for train in trains], match_pool=match_pool)
+      for train, (_, scores) in zip(trains, scores_iter):
+        match_count, scale_amount, feature_proportion = scores
+        for a, b in ((query, train), (train, query)):
+          if match_count > images[a]._best_match_count:
+            images[a]._SetBestMatch(images[b], scores)
+        if (match_count >= match_threshold
+            and scale_amount <= scale_threshold
+            and feature_proportion < feature_threshold):
+          edges.append((query, train))
+  except KeyboardInterrupt as e:
+    print('got ^C, clustering with the pairs scored so far')
+
+  n = len(images)
+  rows, columns = numpy.array(edges, dtype=int).reshape(-1, 2).T
+  graph = scipy.sparse.coo_matrix(
+      (numpy.ones(len(edges)), (rows, columns)), shape=(n, n))
+  num_clusters, labels = scipy.sparse.csgraph.connected_components(
+      graph, directed=False)
+  degrees = numpy.bincount(numpy.concatenate((rows, columns)), minlength=n)
+  print('graph: %d matching pairs, %d clusters' % (len(edges), num_clusters))
+
+  clusters = collections.defaultdict(list)
+  for i, label in enumerate(labels):
+    clusters[label].append(i)
+  representatives = []
+  for cluster in sorted(clusters.values(), key=lambda c: (-len(c), c[0])):
+    representative_i = max(cluster, key=lambda i: (degrees[i], -i))
+    representative = images[representative_i]
+    representative.is_representative = True
+    representative.members = [
+        images[i] for i in cluster if i != representative_i]
+    representatives.append(representative)
+  return representatives
 
 
 def CombineSmallClusters(
-    representatives, match_threshold, scale_threshold, feature_threshold):
+    representatives, match_threshold, scale_threshold, feature_threshold,
+    match_pool=None):
   """Finds small clusters and combines them with existing large clusters.
 
   In the previous step, the representative images for small clusters were only
@@ -364,13 +1588,16 @@ def CombineSmallClusters(
   the faces of the die, and then a long tail of small clusters (1-10 members)
   of images that didn't get a good match. As a heuristic, small clusters are
   those with less than half the members of the largest group.
+
+  A MatchPool scores pairs in parallel (see TakeIntoFirstMatch).
   """
   representatives_by_len = []
   for r in representatives:
     representatives_by_len.append((len(r.members), r, ))
-  representatives_by_len.sort(reverse=True)
+  representatives_by_len.sort(key=lambda n_r: n_r[0], reverse=True)
   cluster_sizes = [n for n, r in representatives_by_len]
 
+  first_small_index = len(representatives_by_len)  # if fewer than two
   for first_small_index in range(1, len(representatives_by_len)):
     if cluster_sizes[first_small_index] < cluster_sizes[0] / 4:
       break
@@ -388,53 +1615,77 @@ def CombineSmallClusters(
       len(main_clusters), len(tail_clusters)))
   not_reparented = []
   for tail_representative in tail_clusters:
-    reparented = False
-    for main_representative in main_clusters:
-      if main_representative.TakeImageIfMatch(
-          tail_representative,
-          match_threshold,
-          scale_threshold,
-          feature_threshold,
-          try_members=True):
-        reparented = True
-        break
-    if not reparented:
+    if not TakeIntoFirstMatch(
+        main_clusters,
+        tail_representative,
+        match_threshold,
+        scale_threshold,
+        feature_threshold,
+        try_members=True,
+        match_pool=match_pool):
       print('failed to reparent', tail_representative.basename)
       not_reparented.append(tail_representative)
 
   return main_clusters + not_reparented
 
 
-def BuildClusterSummaryImage(representatives, raw_max_members):
-  """Draws a composite image summarizing the clusters."""
-  if not representatives:
+def IterClusterSummaryPages(clusters, raw_max_members, page_rows):
+  """Yields composite images summarizing the clusters, a page at a time.
+
+  Clusters are (representative, members) pairs. Each cluster gets a row,
+  holding at most raw_max_members images. With no maximum, a cluster's images
+  wrap onto further rows instead. Each page has at most page_rows rows, so
+  only one page's pixels are in memory at a time.
+  """
+  if not clusters:
     return
-  large_edge = representatives[0].summary_image.size[0]
-  max_members = min(raw_max_members or INF, IMAGE_SIZE_MAX / large_edge)
-  h = large_edge * len(representatives)
-  w = 0
-  for representative in representatives:
-    w = max(w, 1 + len(representative.members))
-  w = min(max_members, w)
-  w *= large_edge
-  summary_image = PIL.Image.new('RGB', (w, h))
-  draw = PIL.ImageDraw.Draw(summary_image)
-  for i, representative in enumerate(representatives):
-    y = i * large_edge
-    all_members = [representative] + representative.members[:max_members - 1]
-    for j, member in enumerate(all_members):
-      x = j * large_edge
-      summary_image.paste(member.summary_image, (x, y))
-      member.DrawOnSummary(draw, (x, y))
-    draw.text(
-        (0, y + 20),
-        'members: %d' % (len(representative.members) + 1), DETAIL_COLOR)
-  return summary_image
+  large_edge = clusters[0][0].summary_image.size[0]
+  max_members = min(raw_max_members or INF, IMAGE_SIZE_MAX // large_edge)
+  row_images = int(min(
+      raw_max_members or SUMMARY_ROW_IMAGES, IMAGE_SIZE_MAX // large_edge))
+  # (images in the row, cluster size if it is the cluster's first row)
+  rows = []
+  for representative, members in clusters:
+    all_members = [representative] + members[:max_members - 1]
+    for start in range(0, len(all_members), row_images):
+      rows.append((
+          all_members[start:start + row_images],
+          None if start else 1 + len(members)))
+  page_rows = min(page_rows, IMAGE_SIZE_MAX // large_edge)
+  for page_start in range(0, len(rows), page_rows):
+    page = rows[page_start:page_start + page_rows]
+    w = large_edge * max(len(images) for images, _ in page)
+    h = large_edge * len(page)
+    summary_image = PIL.Image.new('RGB', (w, h))
+    draw = PIL.ImageDraw.Draw(summary_image)
+    for i, (images, cluster_size) in enumerate(page):
+      y = i * large_edge
+      for j, member in enumerate(images):
+        x = j * large_edge
+        summary_image.paste(member.summary_image, (x, y))
+        member.DrawOnSummary(draw, (x, y))
+      if cluster_size is not None:
+        draw.text((0, y + 20), 'members: %d' % cluster_size, DETAIL_COLOR)
+    yield summary_image
+
+
+def GetSummaryPagePath(summary_image, page_index):
+  """Returns the path for a summary page: summary.jpg, summary-2.jpg, ..."""
+  if not page_index:
+    return summary_image
+  base, extension = os.path.splitext(summary_image)
+  return '%s-%d%s' % (base, page_index + 1, extension)
 
 
 def SaveGrouping(
-    representatives, summary_data, summary_image, summary_max_members=None):
-  """Writes the summary image and the JSON representation of the groupings."""
+    representatives,
+    summary_data,
+    summary_image,
+    summary_max_members=None,
+    summary_page_rows=SUMMARY_PAGE_ROWS_DEFAULT):
+  """Writes the summary image pages and the JSON representation of the
+  groupings. Pages left from an earlier run with more pages are removed.
+  """
   for representative in representatives:
     print(representative.basename, (1 + len(representative.members)))
 
@@ -447,10 +1698,49 @@ def SaveGrouping(
   with open(summary_data, 'w') as data_file:
     json.dump(data_summary, data_file)
 
-  summary = BuildClusterSummaryImage(representatives, summary_max_members)
-  summary.save(summary_image)
-  print('summary image saved to', summary_image)
-  summary.show()
+  first_page = None
+  num_pages = 0
+  for page in IterClusterSummaryPages(
+      [(r, r.members) for r in representatives],
+      summary_max_members,
+      summary_page_rows):
+    page_path = GetSummaryPagePath(summary_image, num_pages)
+    page.save(page_path)
+    print('summary image saved to', page_path)
+    if first_page is None:
+      first_page = page
+    num_pages += 1
+  while os.path.isfile(GetSummaryPagePath(summary_image, num_pages)):
+    os.remove(GetSummaryPagePath(summary_image, num_pages))
+    num_pages += 1
+  first_page.show()
+
+
+class BackgroundSummary(object):
+  """Renders and shows intermediate summary images in a thread, so clustering
+  carries on meanwhile.
+
+  The clusters are copied when a summary is requested; matching may continue
+  to update their images' best match details as they are drawn.
+  """
+  def __init__(self, summary_max_members, summary_page_rows):
+    self._summary_max_members = summary_max_members
+    self._summary_page_rows = summary_page_rows
+    self._thread = None
+
+  def Start(self, representatives):
+    if self._thread is not None and self._thread.is_alive():
+      print('Still rendering the previous intermediate summary.')
+      return
+    clusters = [(r, list(r.members)) for r in representatives]
+    self._thread = threading.Thread(target=self._Render, args=(clusters,))
+    self._thread.daemon = True  # Do not keep a finished run waiting.
+    self._thread.start()
+
+  def _Render(self, clusters):
+    for page in IterClusterSummaryPages(
+        clusters, self._summary_max_members, self._summary_page_rows):
+      page.show()
 
 
 global summary_requested
@@ -492,10 +1782,96 @@ def BuildArgParser():
       '--count-pips', action='store_true', dest='count_pips',
       help='Search for pips (count spots as on a common six-sided die) instead'
            + 'of matching features (as for numerals on a d20).')
+  parser.add_argument(
+      '--matcher', choices=MATCHERS, default=MATCHER_DEFAULT,
+      help='How to match features between images. "bf" compares every pair '
+           + 'of features. "flann" looks features up in a locality sensitive '
+           + 'hashing index of the other image, built once per image, which '
+           + 'is faster for images matched many times (like cluster '
+           + 'representatives) but approximate. Default %s.' % MATCHER_DEFAULT)
+  parser.add_argument(
+      '--matcher-report', action='store_true', dest='matcher_report',
+      help='Also match each pair by brute force, and report how inlier '
+           + 'counts and match decisions from --matcher compare. Pairs with '
+           + 'stored scores are not compared.')
+  parser.add_argument(
+      '--prefilter', action='store_true',
+      help='Skip matching pairs of images whose radial brightness profiles '
+           + 'differ by more than a bound learned from pairs which do match '
+           + '(after the first %d matches). Reports how many pairs are '
+           % PREFILTER_WARMUP_MATCHES
+           + 'skipped, and how many of those audited would have matched.')
+  parser.add_argument(
+      '--prefilter-margin', type=float, default=1.5, dest='prefilter_margin',
+      help='Multiple of the largest profile distance seen for a match to use '
+           + 'as the --prefilter bound. Raise it if too many audited pairs '
+           + 'would have matched.')
+  parser.add_argument(
+      '--prefilter-audit', type=int, default=10, dest='prefilter_audit',
+      help='Match every Nth pair the --prefilter rejects anyway, to estimate '
+           + 'the false reject rate. 0 disables auditing.')
+  parser.add_argument(
+      '--cascade', type=int, nargs=2, metavar=('REJECT', 'ACCEPT'),
+      help='Also detect ORB features (faster to match, but a less precise '
+           + 'threshold), and match them first: pairs with fewer than REJECT '
+           + 'ORB inliers do not match, pairs with at least ACCEPT do, and '
+           + 'only pairs in between are matched with AKAZE features. ORB '
+           + 'inlier counts are on a different scale; the run ends with a '
+           + 'report to help choose the band.')
+  parser.add_argument(
+      '--shortlist', type=int, default=0,
+      help='Only try matching each image against this many cluster '
+           + 'representatives, those with the most similar visual words '
+           + '(from %d words, learned from the first %d images). Much faster '
+           % (VOCABULARY_SIZE, VOCABULARY_TRAIN_IMAGES)
+           + 'when there are many clusters. Default 0 tries every '
+           + 'representative.')
+  parser.add_argument(
+      '--cluster', choices=CLUSTER_MODES, default=CLUSTER_MODES[0],
+      help='How to form clusters. "greedy" adds each image (in directory '
+           + 'order) to the first cluster whose representative it matches, '
+           + 'then combines small clusters into large ones. "graph" matches '
+           + 'each image with the --graph-candidates images most similar to '
+           + 'it (by visual words), and makes clusters of images connected by '
+           + 'matches, which does not depend on the order of the images.')
+  parser.add_argument(
+      '--graph-candidates', type=int, default=10, dest='graph_candidates',
+      help='For --cluster graph, how many similar images to match each image '
+           + 'with.')
+  parser.add_argument(
+      '--jobs', '-j', type=int, default=multiprocessing.cpu_count(),
+      help='Number of worker processes extracting features (or counting pips). '
+           + 'Default is the number of CPUs.')
+  parser.add_argument(
+      '--match-jobs', type=int, default=1, dest='match_jobs',
+      help='Number of worker processes matching features. Each image is '
+           + 'matched against batches of representatives at once, reading '
+           + 'features from the feature store, with the same results as '
+           + 'matching one at a time. Default 1 matches in this process.')
+  parser.add_argument(
+      '--no-feature-store', action='store_false', dest='feature_store',
+      help='Do not use or add to the store of extracted features, %s/ in the '
+           % FEATURE_STORE
+           + 'data directory. Stored features are keyed by the content of each '
+           + 'image, so reruns skip feature detection for unchanged images. '
+           + 'Match scores for each pair of images compared are stored too.')
+  parser.add_argument(
+      '--recluster', action='store_true',
+      help='Only re-cluster, from stored features and pair scores (for '
+           + 'example after changing --match-count-threshold). Pairs not '
+           + 'compared before are scored, but features are not extracted: '
+           + 'images without stored features are skipped.')
   parser.add_argument(
       '--summary-image', '-s', dest='summary_image', default='summary.jpg',
       help='File path for the summary image. If the path is omitted, '
            + 'the summary image is generated and shown but not saved.')
+  parser.add_argument(
+      '--summary-page-rows', default=SUMMARY_PAGE_ROWS_DEFAULT, type=int,
+      dest='summary_page_rows',
+      help='Max number of rows (one per cluster, or more for large clusters '
+           + 'with unlimited --summary-max-members) in each page of the '
+           + 'summary image. Further pages are saved alongside it, as '
+           + 'summary-2.jpg and so on.')
   parser.add_argument(
       '--summary-data', '-d', dest='summary_data', default='summary.json',
       help='File path for the summary data under the data directory. The JSON '
@@ -513,53 +1889,185 @@ if __name__ == '__main__':
   args, positional = parser.parse_known_args()
   if len(positional) != 1:
     parser.error('A single argument for the data directory is required.')
+  if args.jobs < 1:
+    parser.error('--jobs must be at least 1.')
+  if args.summary_page_rows < 1:
+    parser.error('--summary-page-rows must be at least 1.')
+  if args.matcher_report and args.matcher == 'bf':
+    parser.error('--matcher-report compares another --matcher with bf.')
+  if args.prefilter and args.count_pips:
+    parser.error('--prefilter cannot be used with --count-pips.')
+  if args.prefilter_margin < 1.0 or args.prefilter_audit < 0:
+    parser.error(
+        '--prefilter-margin must be at least 1 and --prefilter-audit must '
+        'not be negative.')
+  if args.cascade and (
+      args.count_pips or not 0 <= args.cascade[0] <= args.cascade[1]):
+    parser.error(
+        '--cascade needs 0 <= REJECT <= ACCEPT, and no --count-pips.')
+  if args.cluster == 'graph' and (args.count_pips or args.shortlist):
+    parser.error(
+        '--cluster graph cannot be used with --count-pips or --shortlist.')
+  if args.graph_candidates < 1:
+    parser.error('--graph-candidates must be at least 1.')
+  if args.shortlist < 0:
+    parser.error('--shortlist must not be negative.')
+  if args.shortlist and args.count_pips:
+    parser.error('--shortlist cannot be used with --count-pips.')
+  if args.match_jobs < 1:
+    parser.error('--match-jobs must be at least 1.')
+  if args.match_jobs > 1 and (args.count_pips or not args.feature_store):
+    parser.error(
+        '--match-jobs cannot be used with --count-pips or --no-feature-store.')
+  if args.recluster and (args.count_pips or not args.feature_store):
+    parser.error(
+        '--recluster cannot be used with --count-pips or --no-feature-store.')
   data_dir = positional[0]
   crop_dir = os.path.join(data_dir, args.crop_dir)
   summary_max_members = (
       args.summary_max_members if args.summary_max_members > 0 else None)
 
+  background_summary = BackgroundSummary(
+      summary_max_members, args.summary_page_rows)
   signal.signal(signal.SIGHUP, RequestSummary)
   print('Send SIGHUP (kill -HUP %d) for current summary image.' % os.getpid())
 
   # List of representative images (with their member lists).
   representatives = []
+  # With --cluster graph, all the images, clustered once they are all read.
+  graph_images = []
 
-  cropped_image_names = os.listdir(crop_dir)
+  cropped_image_names = [
+      f for f in os.listdir(crop_dir) if f.lower().endswith(('jpg', 'png'))]
+  if args.cluster == 'graph':
+    cropped_image_names.sort()
   n = len(cropped_image_names)
   failed_files = []
-  try:
-    for i, cropped_image_filename in enumerate(cropped_image_names):
-      if not cropped_image_filename.lower().endswith('jpg'):
-        continue
-      print('%d/%d ' % (i, n))
+  detectors = None
+  if not args.count_pips:
+    detectors = ('akaze', 'orb') if args.cascade else ('akaze',)
+  feature_stores = None
+  store_dir = None
+  vocabulary_path = None
+  if args.feature_store and not args.count_pips:
+    store_dir = os.path.join(data_dir, FEATURE_STORE)
+    vocabulary_path = GetStorePath(
+        store_dir,
+        'vocabulary.npy',
+        '%s/%d/%d' % (
+            FEATURE_CONFIG, VOCABULARY_SIZE, VOCABULARY_TRAIN_IMAGES))
+    feature_stores = dict(
+        (detector, FeatureStore(store_dir, DETECTOR_CONFIGS[detector]))
+        for detector in detectors)
+    _BaseImageComparison._thumbnails = ThumbnailCache(
+        THUMBNAIL_CACHE_SIZE,
+        os.path.join(store_dir, 'thumbnails%d' % SUMMARY_MEMBER_IMAGE_SIZE))
+    FeatureComparison.pair_scores = PairScoreStore(GetStorePath(
+        store_dir, 'pairscores.bin', PAIR_SCORE_CONFIG % GetMatcherConfig(
+            args.matcher)))
+    print('%d pair scores are stored.' % len(FeatureComparison.pair_scores))
+  FeatureComparison.matcher = args.matcher
+  if args.matcher_report:
+    FeatureComparison.matcher_report = MatcherReport()
+  if args.prefilter:
+    FeatureComparison.prefilter = SignaturePrefilter(
+        args.prefilter_margin,
+        args.prefilter_audit,
+        args.match_threshold,
+        args.scale_threshold,
+        args.feature_threshold)
+  if args.cascade:
+    FeatureComparison.cascade = MatchCascade(
+        args.cascade[0], args.cascade[1], args.match_threshold)
+  representative_index = None
+  with MatchPool(args.match_jobs, store_dir, detectors) as match_pool:
+    with ExtractionPool(1 if args.recluster else args.jobs) as extraction_pool:
       try:
-        AssignToCluster(
-            os.path.join(crop_dir, cropped_image_filename),
+        image_data_iter = IterImageData(
+            extraction_pool,
+            [os.path.join(crop_dir, f) for f in cropped_image_names],
+            detectors,
+            feature_stores,
+            extract_missing=not args.recluster)
+        if args.shortlist or args.cluster == 'graph':
+          # Learn words from the first usable images, then cluster them as
+          # usual. With none, there is nothing to cluster.
+          first_image_data = []
+          train_descriptors = []
+          for image_data_item in image_data_iter:
+            first_image_data.append(image_data_item)
+            _, _, image_data, error = image_data_item
+            if error is None:
+              train_descriptors.append(
+                  (image_data.fine if args.cascade else image_data).descriptors)
+              if len(train_descriptors) >= VOCABULARY_TRAIN_IMAGES:
+                break
+          image_data_iter = itertools.chain(first_image_data, image_data_iter)
+          if train_descriptors:
+            representative_index = RepresentativeIndex(
+                LoadVocabulary(vocabulary_path, train_descriptors))
+        for i, (cropped_image_path, sha1, image_data, error) in enumerate(
+            image_data_iter):
+          print('%d/%d ' % (i, n))
+          cropped_image_filename = os.path.basename(cropped_image_path)
+          if error is not None:
+            print(error)
+            failed_files.append(cropped_image_filename)
+            continue
+          if args.cluster == 'graph':
+            graph_images.append(FeatureComparison(
+                cropped_image_path, image_data, sha1))
+            representative_index.Add(graph_images[-1])
+            continue
+          try:
+            AssignToCluster(
+                cropped_image_path,
+                sha1,
+                image_data,
+                representatives,
+                args.match_threshold,
+                args.scale_threshold,
+                args.feature_threshold,
+                representative_index,
+                args.shortlist,
+                match_pool)
+          except cv2.error as e:
+            print(e)
+            failed_files.append(cropped_image_filename)
+          if summary_requested:
+            print('Rendering intermediate summary in the background.')
+            summary_requested = False
+            background_summary.Start(representatives)
+      except KeyboardInterrupt as e:
+        print('got ^C, early stop for categorization')
+
+    if args.cluster == 'graph':
+      if graph_images:
+        representatives = ClusterGraph(
+            graph_images,
+            args.match_threshold,
+            args.scale_threshold,
+            args.feature_threshold,
+            representative_index,
+            args.graph_candidates,
+            match_pool)
+    else:
+      try:
+        representatives = CombineSmallClusters(
             representatives,
             args.match_threshold,
             args.scale_threshold,
             args.feature_threshold,
-            args.count_pips)
-      except (NoFeaturesError, cv2.error) as e:
-        print(e)
-        failed_files.append(cropped_image_filename)
-      if summary_requested:
-        print('Rendering intermediate summary.')
-        summary_requested = False
-        BuildClusterSummaryImage(
-            representatives, summary_max_members).show()
-  except KeyboardInterrupt as e:
-    print('got ^C, early stop for categorization')
-
-  try:
-    representatives = CombineSmallClusters(
-        representatives,
-        args.match_threshold,
-        args.scale_threshold,
-        args.feature_threshold)
-  except KeyboardInterrupt as e:
-    print('got ^C, cancelling combining clusters')
-
+            match_pool)
+      except KeyboardInterrupt as e:
+        print('got ^C, cancelling combining clusters')
+
+  if FeatureComparison.matcher_report:
+    FeatureComparison.matcher_report.Print(args.matcher, args.match_threshold)
+  if FeatureComparison.prefilter:
+    FeatureComparison.prefilter.Print()
+  if FeatureComparison.cascade:
+    FeatureComparison.cascade.Print()
   print(len(failed_files), 'failed files:', failed_files)
   if not representatives:
     print('No data!')
@@ -569,4 +2077,5 @@ if __name__ == '__main__':
       representatives,
       os.path.join(data_dir, args.summary_data),
       os.path.join(data_dir, args.summary_image),
-      summary_max_members)
+      summary_max_members,
+      args.summary_page_rows)
@@ -24,7 +24,9 @@ import os
 def GetLabelSequence(labeled_file_sets):
   """Transforms {label: set(files)} to ordered [labels].
 
-  Assumes filenames reflect roll ordering.
+  Assumes filenames reflect roll ordering. With several dice per capture
+  (crop.py --dice), crops of the same capture are suffixed _a, _b, ... and so
+  sort together, so each die in a capture is a consecutive roll.
   """
   file_to_label = []
   for label, files in labeled_file_sets.items():
@@ -55,7 +57,7 @@ if __name__ == '__main__':
       help='Name of a file to write labels.')
   args, positional = parser.parse_known_args()
   data_dir = positional[0]
-  labels = map(int, positional[1:])
+  labels = list(map(int, positional[1:]))
 
   summary_data_filename = os.path.join(data_dir, args.summary_data)
   with open(summary_data_filename) as data_file:
@@ -80,7 +82,7 @@ if __name__ == '__main__':
   labeled_file_sets = collections.defaultdict(lambda: set())
   for filename_list, label in zip(summary_data, labels):
     labeled_file_sets[label].update(filename_list)
-  for i in xrange(1, max(labels) + 1):
+  for i in range(1, max(labels) + 1):
     if i not in labeled_file_sets:
       print('warning, missing label', i)
       labeled_file_sets[i] = set()